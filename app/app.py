@@ -1,35 +1,44 @@
-import base64
+import os
+import asyncio
+from contextlib import suppress
 from datetime import datetime
-from uuid import UUID
-from fastapi import APIRouter, Depends, HTTPException, Response
+
+from fastapi import Depends, Header, HTTPException, Request
 from sqlalchemy.ext.asyncio import AsyncSession
 from pydantic import BaseModel
 from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
 
 from app.site_router.site_views import site_router
-from app.setup_logger import logger
-from app.database.engine import create_db
+from app.database.engine import create_db, engine, log_pool_stats, warm_pool
 from app.tg_bot_router.bot import start_bot, stop_bot, bot_router
 from app.payment_router.payment_views import payment_router
 from app.skynet_api_router.skynet_api_views import api_router
 from app.database.engine import get_async_session
 from app.tg_bot_router.bot import bot
-from app.setup_logger import logger
 from app.payment_router.payment_views import recurent_payment
-from app.database.queries import (
-    orm_get_servers,
-    orm_get_user_by_tgid,
-    orm_get_user_servers,
+from app.payment_router.provisioning import run_provisioning_worker
+from app.database.queries import orm_get_user, orm_get_user_by_tgid
+from app.skynet_api_router.subscription import (
+    get_cached_subscription,
+    get_prerendered_subscription,
+    prerender_subscriptions,
+    refresh_inbound_profiles,
+    render_subscription,
+    subscription_version,
 )
-from app.utils.three_x_ui_api import ThreeXUIServer
+from app.utils.three_x_ui_api import close_panel_clients
+from app.utils.rate_limiter import check_rate_limit, too_many_requests
+from app.utils.sub_tokens import telegram_id_tokens_accepted, verify_user_token
 from app.payment_router.payment_views import recurent_payment, check_subscription_expiry, reset_monthly_traffic,notify_expired_users
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     await create_db()
+    await warm_pool()
     await start_bot()
 
     expired_trigger = CronTrigger(
@@ -77,9 +86,39 @@ async def lifespan(app: FastAPI):
         args=[bot]
     )
 
+    # Профили индаубов: сразу при старте и дальше по интервалу
+    scheduler.add_job(
+        refresh_inbound_profiles,
+        trigger=IntervalTrigger(minutes=int(os.getenv("INBOUND_PROFILE_REFRESH_MINUTES", 30))),
+        id='refresh_inbound_profiles',
+        replace_existing=True,
+        next_run_time=datetime.now()
+    )
+
+    scheduler.add_job(
+        prerender_subscriptions,
+        trigger=IntervalTrigger(minutes=int(os.getenv("SUBSCRIPTION_PRERENDER_MINUTES", 5))),
+        id='prerender_subscriptions',
+        replace_existing=True,
+        max_instances=1
+    )
+
+    scheduler.add_job(
+        log_pool_stats,
+        trigger=IntervalTrigger(minutes=int(os.getenv("DB_POOL_STATS_MINUTES", 5))),
+        id='log_pool_stats',
+        replace_existing=True
+    )
+
     scheduler.start()
+    provisioning_worker = asyncio.create_task(run_provisioning_worker(bot))
     yield
+    provisioning_worker.cancel()
+    with suppress(asyncio.CancelledError):
+        await provisioning_worker
     await stop_bot()
+    await close_panel_clients()
+    await engine.dispose()
 
 
 scheduler = AsyncIOScheduler()
@@ -92,61 +131,41 @@ app.include_router(api_router, tags=['Rest API'])
 
 
 @app.get("/subscription")
-async def generate_subscription_config(user_token: str, session: AsyncSession = Depends(get_async_session)):
-    user = await orm_get_user_by_tgid(session, int(user_token))
-    user_servers = await orm_get_user_servers(session, user.id)
-    if not user or not user_servers:
+async def generate_subscription_config(
+    user_token: str,
+    request: Request,
+    if_none_match: str | None = Header(None),
+    session: AsyncSession = Depends(get_async_session)
+):
+    user_id = verify_user_token(user_token)
+    if user_id is None and not (telegram_id_tokens_accepted() and user_token.isdigit()):
         raise HTTPException(status_code=404, detail="User not found or no servers available")
 
-    # 3. Генерируем vless:// ссылки для каждого сервера
-    config_lines = []
-    
-    servers = await orm_get_servers(session)
-    threex_panels = []
-    for server in servers:
-        threex_panels.append(ThreeXUIServer(
-            server.id,
-            server.url,
-            server.indoub_id,
-            server.login,
-            server.password,
-            server.need_gb
-        ))
-    for user_server in user_servers:
-        vless_url = None
-        for panel in threex_panels:
-            if panel.id == user_server.server_id:
-                vless_url = await panel.get_client_vless(user_server.tun_id)
-                if panel.need_gb == True:
-                    trafic = await panel.client_remain_trafic(user_server.tun_id) or 0
-
-
-        
-        if not vless_url:
-            logger.warning(f"Пользователь не найден на сервере {user_server.server_id}")
-            continue
-        config_lines.append(vless_url)
-    
-    if not config_lines:
-        raise HTTPException(status_code=404, detail="Не найдены сервера")
-    subscription_content = "\n".join(config_lines)
-
-    response = Response(
-        content=subscription_content,
-        media_type="text/plain; charset=utf-8"
-    )
-
-    response.headers['profile-title'] = "base64:"+base64.b64encode('⚡️ SkynetVPN'.encode('utf-8')).decode('latin-1')
-    response.headers["announce"] = "base64:"+base64.b64encode(f"🚀 Нажмите сюда, чтобы перейти в нашего бота\n\n👑 - без рекламы на YouTube\n🎧 - YouTube можно сворачивать \n\nОтображаемое количество трафика относиться только к обходу белых списков.".encode('utf-8')).decode('latin-1')
-    response.headers["announce-url"] = "https://t.me/skynetaivpn_bot"
-    response.headers["subscription-userinfo"] = f"expire={int(user.sub_end.timestamp())}; upload={trafic[0]}; download={trafic[1]}; total={trafic[2]}"
-    response.headers["X-Frame-Options"] = 'SAMEORIGIN'
-    response.headers["Referrer-Policy"] = 'no-referrer-when-downgrade'
-    response.headers["X-Content-Type-Options"] = 'nosniff'
-    response.headers["Permissions-Policy"] = 'geolocation=(), microphone=()'
-    response.headers["Strict-Transport-Security"] = "max-age=63072000; includeSubDomains; preload"
-
-
-    return response
-
-
+    retry_after = check_rate_limit(request, user_token)
+    version = subscription_version()
+    user = None
+    if user_id is None:
+        # Старые ссылки по telegram_id: без обращения к БД кэш не найти, поэтому сверх лимита сразу 429
+        if retry_after:
+            raise too_many_requests(retry_after)
+        user = await orm_get_user_by_tgid(session, int(user_token))
+        if not user:
+            raise HTTPException(status_code=404, detail="User not found or no servers available")
+        user_id = user.id
+
+    cached = get_cached_subscription(user_id, if_none_match)
+    if cached:
+        return cached
+    if retry_after:
+        raise too_many_requests(retry_after)
+
+    prerendered = await get_prerendered_subscription(session, user_id, if_none_match)
+    if prerendered:
+        return prerendered
+
+    if user is None:
+        user = await orm_get_user(session, user_id)
+        if not user:
+            raise HTTPException(status_code=404, detail="User not found or no servers available")
+
+    return await render_subscription(session, user, if_none_match, version)
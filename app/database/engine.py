@@ -1,26 +1,132 @@
 import os
+import time
+from contextlib import AsyncExitStack
 
 from collections.abc import AsyncGenerator
 
+from sqlalchemy import event, text
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
-from app.database.models import Base
+from app.database.migrations import SCHEMA_VERSION, get_schema_version, migrate
+from app.setup_logger import logger
 
 
-engine = create_async_engine(str(os.getenv("DB_URL")), echo=False)
+DB_URL = str(os.getenv("DB_URL"))
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 10))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 20))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 10))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "1").lower() in ("1", "true", "yes")
+# Сколько соединений открываем заранее при старте
+DB_POOL_WARMUP = int(os.getenv("DB_POOL_WARMUP", DB_POOL_SIZE))
+# Кэш подготовленных выражений asyncpg на соединение
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", 500))
+
+
+class PoolStats:
+    """Счетчики пула за период между выводами в лог"""
+    def __init__(self) -> None:
+        self.in_use = 0
+        self.reset()
+
+
+    def reset(self):
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.in_use_max = self.in_use
+
+
+    def record_wait(self, seconds: float):
+        self.waits += 1
+        self.wait_total += seconds
+        self.wait_max = max(self.wait_max, seconds)
+
+
+    def checkout(self):
+        self.checkouts += 1
+        self.in_use += 1
+        self.in_use_max = max(self.in_use_max, self.in_use)
+
+
+    def checkin(self):
+        self.in_use = max(0, self.in_use - 1)
+
+
+pool_stats = PoolStats()
+
+
+class MeteredQueuePool(AsyncAdaptedQueuePool):
+    """Пул, который замеряет ожидание свободного соединения"""
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            pool_stats.record_wait(time.perf_counter() - started)
+
+
+def _connect_args() -> dict:
+    if DB_URL.startswith("postgresql+asyncpg"):
+        return {"prepared_statement_cache_size": DB_STATEMENT_CACHE_SIZE}
+    return {}
+
+
+engine = create_async_engine(
+    DB_URL,
+    echo=False,
+    poolclass=MeteredQueuePool,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
+    pool_recycle=DB_POOL_RECYCLE,
+    pool_pre_ping=DB_POOL_PRE_PING,
+    connect_args=_connect_args()
+)
 async_session_maker = async_sessionmaker(engine, expire_on_commit=False)
 
 
+@event.listens_for(engine.sync_engine, "checkout")
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+    pool_stats.checkout()
+
+
+@event.listens_for(engine.sync_engine, "checkin")
+def _on_checkin(dbapi_connection, connection_record):
+    pool_stats.checkin()
+
+
 async def create_db():
+    """При старте только сверяет версию схемы; миграции применяются, если она устарела"""
     async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+        if await get_schema_version(conn) >= SCHEMA_VERSION:
+            return
+        await migrate(conn)
 
 
-async def get_async_session() -> AsyncGenerator[AsyncSession, None]:
-    async with async_session_maker() as session:
-        yield session
-
+async def warm_pool():
+    """Открывает соединения пула заранее, чтобы первые запросы не ждали подключения к БД"""
+    count = min(DB_POOL_WARMUP, DB_POOL_SIZE)
+    async with AsyncExitStack() as stack:
+        for _ in range(count):
+            conn = await stack.enter_async_context(engine.connect())
+            await conn.execute(text("SELECT 1"))
+    logger.info(f"Пул БД прогрет: {count} соединений")
 
 
+async def log_pool_stats():
+    stats = pool_stats
+    average = stats.wait_total / stats.waits * 1000 if stats.waits else 0
+    logger.info(
+        f"Пул БД: выдач {stats.checkouts}, занято сейчас {stats.in_use}, максимум {stats.in_use_max} "
+        f"из {DB_POOL_SIZE}+{DB_MAX_OVERFLOW}, ожидание среднее {average:.1f} мс, "
+        f"максимальное {stats.wait_max * 1000:.1f} мс; {engine.pool.status()}"
+    )
+    stats.reset()
 
 
+async def get_async_session() -> AsyncGenerator[AsyncSession, None]:
+    async with async_session_maker() as session:
+        yield session
@@ -0,0 +1,226 @@
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from app.setup_logger import logger
+
+
+# Номер блокировки pg_advisory_xact_lock, чтобы два процесса не мигрировали одновременно
+MIGRATIONS_LOCK_ID = 7_301_001
+
+
+# Схема версии 1 зафиксирована как есть, а не берется из моделей: иначе новая БД сразу получила бы
+# текущую схему под номером 1, а следующие миграции выполнялись бы поверх уже внесенных изменений
+_BASELINE_TABLES = (
+    "CREATE TABLE IF NOT EXISTS users ("
+    "id UUID PRIMARY KEY, "
+    "telegram_id BIGINT NOT NULL, "
+    "name VARCHAR(50) NOT NULL, "
+    "email VARCHAR(255), "
+    "tariff_id INTEGER NOT NULL, "
+    "sub_end TIMESTAMP WITHOUT TIME ZONE, "
+    "ips INTEGER NOT NULL, "
+    "invited_by BIGINT, "
+    "blocked BOOLEAN NOT NULL, "
+    "super_user BOOLEAN NOT NULL, "
+    "created TIMESTAMP WITHOUT TIME ZONE NOT NULL, "
+    "updated TIMESTAMP WITHOUT TIME ZONE NOT NULL"
+    ")",
+    "CREATE TABLE IF NOT EXISTS tariffs ("
+    "id SERIAL PRIMARY KEY, "
+    "days INTEGER NOT NULL, "
+    "ips INTEGER NOT NULL, "
+    "trafic INTEGER NOT NULL, "
+    "price NUMERIC(10, 2) NOT NULL, "
+    "created TIMESTAMP WITHOUT TIME ZONE NOT NULL, "
+    "updated TIMESTAMP WITHOUT TIME ZONE NOT NULL"
+    ")",
+    "CREATE TABLE IF NOT EXISTS faqs ("
+    "id SERIAL PRIMARY KEY, "
+    "ask TEXT NOT NULL, "
+    "answer TEXT NOT NULL, "
+    "created TIMESTAMP WITHOUT TIME ZONE NOT NULL, "
+    "updated TIMESTAMP WITHOUT TIME ZONE NOT NULL"
+    ")",
+    "CREATE TABLE IF NOT EXISTS servers ("
+    "id SERIAL PRIMARY KEY, "
+    "name VARCHAR(100) NOT NULL, "
+    "url VARCHAR(500) NOT NULL, "
+    "indoub_id INTEGER NOT NULL, "
+    "login VARCHAR(50) NOT NULL, "
+    "password VARCHAR(100) NOT NULL, "
+    "need_gb BOOLEAN NOT NULL, "
+    "created TIMESTAMP WITHOUT TIME ZONE NOT NULL, "
+    "updated TIMESTAMP WITHOUT TIME ZONE NOT NULL"
+    ")",
+    "CREATE TABLE IF NOT EXISTS payments ("
+    "id SERIAL PRIMARY KEY, "
+    "user_id UUID REFERENCES users (id), "
+    "tariff_id INTEGER NOT NULL REFERENCES tariffs (id), "
+    "recurent BOOLEAN NOT NULL, "
+    "created TIMESTAMP WITHOUT TIME ZONE NOT NULL, "
+    "updated TIMESTAMP WITHOUT TIME ZONE NOT NULL"
+    ")",
+    "CREATE TABLE IF NOT EXISTS users_servers ("
+    "id SERIAL PRIMARY KEY, "
+    "tun_id TEXT NOT NULL, "
+    "user_id UUID REFERENCES users (id), "
+    "server_id INTEGER NOT NULL REFERENCES servers (id), "
+    "created TIMESTAMP WITHOUT TIME ZONE NOT NULL, "
+    "updated TIMESTAMP WITHOUT TIME ZONE NOT NULL"
+    ")",
+    "CREATE TABLE IF NOT EXISTS inbound_profiles ("
+    "server_id INTEGER PRIMARY KEY REFERENCES servers (id), "
+    "profile TEXT NOT NULL, "
+    "link_template TEXT NOT NULL, "
+    "created TIMESTAMP WITHOUT TIME ZONE NOT NULL, "
+    "updated TIMESTAMP WITHOUT TIME ZONE NOT NULL"
+    ")",
+    "CREATE TABLE IF NOT EXISTS rendered_subscriptions ("
+    "user_id UUID PRIMARY KEY REFERENCES users (id), "
+    "body TEXT NOT NULL, "
+    "headers TEXT NOT NULL, "
+    "expires TIMESTAMP WITHOUT TIME ZONE, "
+    "created TIMESTAMP WITHOUT TIME ZONE NOT NULL, "
+    "updated TIMESTAMP WITHOUT TIME ZONE NOT NULL"
+    ")",
+)
+
+
+async def _create_tables(conn: AsyncConnection):
+    for statement in _BASELINE_TABLES:
+        await conn.execute(text(statement))
+
+
+async def _unique_telegram_id(conn: AsyncConnection):
+    """
+    Уникальный индекс по users.telegram_id - на нем держится INSERT ... ON CONFLICT в orm_add_user.
+    Повторяющихся пользователей миграция не трогает: слияние затрагивает платежи и клиентов на панелях,
+    его делает оператор. Пока дубликаты есть, миграция прерывается со списком telegram_id
+    """
+    duplicates = (await conn.execute(text(
+        "SELECT telegram_id FROM users GROUP BY telegram_id HAVING count(*) > 1 ORDER BY telegram_id"
+    ))).scalars().all()
+    if duplicates:
+        raise RuntimeError(
+            "В users повторяющиеся telegram_id, уникальный индекс не создать. "
+            f"Объедините или удалите записи вручную и перезапустите приложение: {', '.join(map(str, duplicates))}"
+        )
+
+    # Индекс, созданный раньше без UNIQUE, пересоздаем
+    unique = await conn.scalar(text(
+        "SELECT indisunique FROM pg_index WHERE indexrelid = to_regclass('ix_users_telegram_id')"
+    ))
+    if unique is False:
+        await conn.execute(text("DROP INDEX ix_users_telegram_id"))
+    await conn.execute(text(
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_users_telegram_id ON users (telegram_id)"
+    ))
+
+
+async def _add_indexes(conn: AsyncConnection):
+    await _unique_telegram_id(conn)
+
+    for statement in (
+        "CREATE INDEX IF NOT EXISTS ix_users_sub_end ON users (sub_end)",
+        "CREATE INDEX IF NOT EXISTS ix_users_subscribers ON users (sub_end) WHERE tariff_id > 0",
+        "CREATE INDEX IF NOT EXISTS ix_users_servers_user_server ON users_servers (user_id, server_id)",
+        "CREATE INDEX IF NOT EXISTS ix_users_servers_server_id ON users_servers (server_id)",
+        "CREATE INDEX IF NOT EXISTS ix_users_servers_tun_id ON users_servers (tun_id)",
+        "CREATE INDEX IF NOT EXISTS ix_payments_user_id ON payments (user_id, id)",
+    ):
+        await conn.execute(text(statement))
+
+
+async def _add_provisioning_jobs(conn: AsyncConnection):
+    await conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS provisioning_jobs ("
+        "id SERIAL PRIMARY KEY, "
+        "payment_id INTEGER NOT NULL UNIQUE REFERENCES payments (id), "
+        "email VARCHAR(255), "
+        "status VARCHAR(20) NOT NULL, "
+        "attempts INTEGER NOT NULL, "
+        "next_attempt_at TIMESTAMP WITHOUT TIME ZONE NOT NULL, "
+        "sub_end TIMESTAMP WITHOUT TIME ZONE, "
+        "notified BOOLEAN NOT NULL, "
+        "last_error TEXT, "
+        "created TIMESTAMP WITHOUT TIME ZONE NOT NULL, "
+        "updated TIMESTAMP WITHOUT TIME ZONE NOT NULL"
+        ")"
+    ))
+    await conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_provisioning_jobs_due ON provisioning_jobs (status, next_attempt_at)"
+    ))
+
+
+async def _add_payment_status(conn: AsyncConnection):
+    await conn.execute(text(
+        "ALTER TABLE payments ADD COLUMN IF NOT EXISTS status VARCHAR(20) NOT NULL DEFAULT 'pending'"
+    ))
+    # Платежи, по которым уже есть задача выдачи доступа, оплачены
+    await conn.execute(text(
+        "UPDATE payments SET status = CASE WHEN j.status = 'done' THEN 'provisioned' ELSE 'paid' END "
+        "FROM provisioning_jobs j WHERE j.payment_id = payments.id AND payments.status = 'pending'"
+    ))
+    await _backfill_processed_payments(conn)
+    await conn.execute(text("CREATE INDEX IF NOT EXISTS ix_payments_status ON payments (status)"))
+
+
+async def _backfill_processed_payments(conn: AsyncConnection):
+    """
+    Платежи до очереди provisioning_jobs обрабатывались сразу в callback и отметки об этом не имеют:
+    среди них и оплаченные, и брошенные счета (payment_page создает счет при каждом открытии).
+    Им ставится статус legacy: callback по такому счету не выдает доступ автоматически (повтор выдал бы
+    его еще раз), а сообщает администраторам. Счета за последние сутки остаются pending:
+    их могли выставить до обновления и оплатить после
+    """
+    await conn.execute(text(
+        "UPDATE payments SET status = 'legacy' "
+        "WHERE status = 'pending' "
+        "AND created < LOCALTIMESTAMP - INTERVAL '1 day' "
+        "AND NOT EXISTS (SELECT 1 FROM provisioning_jobs j WHERE j.payment_id = payments.id) "
+        "AND id < COALESCE((SELECT min(payment_id) FROM provisioning_jobs), 2147483647)"
+    ))
+
+
+
+async def _paid_without_job_to_legacy(conn: AsyncConnection):
+    # Callback всегда ставит paid вместе с задачей выдачи доступа, без задачи paid мог проставить только backfill
+    await conn.execute(text(
+        "UPDATE payments SET status = 'legacy' "
+        "WHERE status = 'paid' "
+        "AND NOT EXISTS (SELECT 1 FROM provisioning_jobs j WHERE j.payment_id = payments.id)"
+    ))
+
+
+# Миграции применяются по порядку и после выпуска не меняются - новые изменения схемы только новой версией
+MIGRATIONS = [
+    (1, "Создание таблиц", _create_tables),
+    (2, "Индексы users, users_servers, payments", _add_indexes),
+    (3, "Очередь выдачи доступа provisioning_jobs", _add_provisioning_jobs),
+    (4, "Статус платежа payments.status", _add_payment_status),
+    (5, "Уникальный users.telegram_id там, где версия 2 создала индекс без UNIQUE", _unique_telegram_id),
+    (6, "Статус legacy для платежей до очереди выдачи доступа", _backfill_processed_payments),
+    (7, "paid без задачи выдачи доступа (проставлен версиями 4 и 6) - legacy", _paid_without_job_to_legacy),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+async def get_schema_version(conn: AsyncConnection) -> int:
+    exists = await conn.scalar(text("SELECT to_regclass('schema_version') IS NOT NULL"))
+    if not exists:
+        return 0
+    return await conn.scalar(text("SELECT max(version) FROM schema_version")) or 0
+
+
+async def migrate(conn: AsyncConnection):
+    """Применяет недостающие миграции в одной транзакции"""
+    await conn.execute(text("SELECT pg_advisory_xact_lock(:lock_id)"), {"lock_id": MIGRATIONS_LOCK_ID})
+    await conn.execute(text("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)"))
+    version = await get_schema_version(conn)
+
+    for number, description, apply in MIGRATIONS:
+        if number <= version:
+            continue
+        logger.info(f"Миграция БД {number}: {description}")
+        await apply(conn)
+        await conn.execute(text("INSERT INTO schema_version (version) VALUES (:version)"), {"version": number})
@@ -1,7 +1,7 @@
 import uuid
 
 from sqlalchemy.dialects.postgresql import UUID
-from sqlalchemy import BigInteger, Boolean, DateTime, ForeignKey, Integer, Numeric, String, Text, func, nullslast
+from sqlalchemy import BigInteger, Boolean, DateTime, ForeignKey, Index, Integer, Numeric, String, Text, func, nullslast, text
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 
 
@@ -12,6 +12,11 @@ class Base(DeclarativeBase):
 
 class User(Base):
     __tablename__ = 'users'
+    __table_args__ = (
+        Index('ix_users_telegram_id', 'telegram_id', unique=True),
+        Index('ix_users_sub_end', 'sub_end'),
+        Index('ix_users_subscribers', 'sub_end', postgresql_where=text('tariff_id > 0')),
+    )
 
     id = mapped_column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     telegram_id: Mapped[int] = mapped_column(BigInteger, nullable=False)
@@ -24,6 +29,9 @@ class User(Base):
     blocked: Mapped[bool] = mapped_column(Boolean, default=False)
     super_user: Mapped[bool] = mapped_column(Boolean, default=False)
 
+    # Только для чтения (selectinload в orm_get_payment): связи меняются через orm_* функции
+    servers = relationship(argument="UserServer", viewonly=True)
+
 
 class Tariff(Base):
     __tablename__ = 'tariffs'
@@ -45,15 +53,46 @@ class FAQ(Base):
 
 class Payment(Base):
     __tablename__ = 'payments'
+    __table_args__ = (
+        Index('ix_payments_user_id', 'user_id', 'id'),
+        Index('ix_payments_status', 'status'),
+    )
+
+    # Статусы: счет создан -> оплата подтверждена callback'ом -> доступ выдан
+    PENDING = 'pending'
+    PAID = 'paid'
+    PROVISIONED = 'provisioned'
+    # Счет до очереди выдачи доступа: неизвестно, оплачен ли и выдан ли по нему доступ
+    LEGACY = 'legacy'
+    # По legacy-счету пришел callback - проверяет администратор
+    REVIEW = 'review'
 
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     user_id = mapped_column(UUID(as_uuid=True), ForeignKey('users.id'))
     tariff_id: Mapped[int] = mapped_column(Integer(), ForeignKey('tariffs.id'))
     recurent: Mapped[bool] = mapped_column(Boolean(), default=False)
+    status: Mapped[str] = mapped_column(String(20), default=PENDING, server_default=PENDING)
     user = relationship(argument="User")
     tariff = relationship(argument="Tariff")
 
 
+class ProvisioningJob(Base):
+    __tablename__ = 'provisioning_jobs'
+    __table_args__ = (
+        Index('ix_provisioning_jobs_due', 'status', 'next_attempt_at'),
+    )
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    payment_id: Mapped[int] = mapped_column(Integer, ForeignKey('payments.id'), unique=True)
+    email: Mapped[str] = mapped_column(String(255), nullable=True)
+    status: Mapped[str] = mapped_column(String(20), default='pending')
+    attempts: Mapped[int] = mapped_column(Integer, default=0)
+    next_attempt_at: Mapped[DateTime] = mapped_column(DateTime)
+    sub_end: Mapped[DateTime] = mapped_column(DateTime, nullable=True)
+    notified: Mapped[bool] = mapped_column(Boolean, default=False)
+    last_error: Mapped[str] = mapped_column(Text, nullable=True)
+
+
 class Server(Base):
     __tablename__ = 'servers'
 
@@ -65,9 +104,31 @@ class Server(Base):
     password: Mapped[str] = mapped_column(String(100), nullable=False)
     need_gb: Mapped[bool] = mapped_column(Boolean(), default=False)
 
+
+class InboundProfile(Base):
+    __tablename__ = 'inbound_profiles'
+
+    server_id: Mapped[int] = mapped_column(Integer, ForeignKey("servers.id"), primary_key=True)
+    profile: Mapped[str] = mapped_column(Text())
+    link_template: Mapped[str] = mapped_column(Text())
+
  
+class RenderedSubscription(Base):
+    __tablename__ = 'rendered_subscriptions'
+
+    user_id = mapped_column(UUID(as_uuid=True), ForeignKey('users.id'), primary_key=True)
+    body: Mapped[str] = mapped_column(Text())
+    headers: Mapped[str] = mapped_column(Text())
+    expires: Mapped[DateTime] = mapped_column(DateTime, nullable=True)
+
+
 class UserServer(Base):
     __tablename__ = 'users_servers'
+    __table_args__ = (
+        Index('ix_users_servers_user_server', 'user_id', 'server_id'),
+        Index('ix_users_servers_server_id', 'server_id'),
+        Index('ix_users_servers_tun_id', 'tun_id'),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     tun_id: Mapped[str] = mapped_column(Text())
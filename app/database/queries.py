@@ -1,11 +1,100 @@
-from datetime import datetime
+import os
+from datetime import datetime, timedelta
 from typing import Optional
 from uuid import UUID
-from sqlalchemy import DateTime, delete, select, update
+from sqlalchemy import DateTime, case, delete, func, or_, select, update
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import query, selectinload
 
-from app.database.models import User, UserServer, Server, Payment, Tariff, FAQ
+from app.database.models import (
+    User,
+    UserServer,
+    Server,
+    Payment,
+    Tariff,
+    FAQ,
+    InboundProfile,
+    ProvisioningJob,
+    RenderedSubscription
+)
+from app.utils.panel_registry import panel_registry
+from app.utils.subscription_cache import subscription_cache
+
+
+# Сколько строк за раз читаем с серверного курсора в потоковых выборках
+DB_STREAM_CHUNK = int(os.getenv("DB_STREAM_CHUNK", 1000))
+
+
+# RenderedSubscription
+async def _invalidate_subscriptions(session: AsyncSession, user_id: Optional[UUID] = None):
+    '''Сбрасывает готовые подписки пользователя (или всех) в памяти и в БД. Вызывается до commit'''
+    if user_id is not None:
+        await _invalidate_users_subscriptions(session, [user_id])
+        return
+    subscription_cache.clear()
+    await session.execute(delete(RenderedSubscription))
+
+
+async def _invalidate_users_subscriptions(session: AsyncSession, user_ids):
+    '''Сбрасывает готовые подписки перечисленных пользователей. Вызывается до commit'''
+    user_ids = set(user_ids)
+    if not user_ids:
+        return
+    for user_id in user_ids:
+        subscription_cache.invalidate(user_id)
+    await session.execute(delete(RenderedSubscription).where(RenderedSubscription.user_id.in_(user_ids)))
+
+
+async def orm_get_rendered_subscription(session: AsyncSession, user_id: UUID):
+    query = select(RenderedSubscription).where(RenderedSubscription.user_id == user_id)
+    result = await session.execute(query)
+    return result.scalar()
+
+
+async def orm_save_rendered_subscription(
+    session: AsyncSession,
+    user_id: UUID,
+    body: str,
+    headers: str,
+    expires: Optional[datetime] = None
+):
+    query = insert(RenderedSubscription).values(
+        user_id=user_id,
+        body=body,
+        headers=headers,
+        expires=expires
+    )
+    query = query.on_conflict_do_update(
+        index_elements=[RenderedSubscription.user_id],
+        set_={
+            'body': query.excluded.body,
+            'headers': query.excluded.headers,
+            'expires': query.excluded.expires,
+            'updated': func.now()
+        }
+    )
+    await session.execute(query)
+    await session.commit()
+
+
+async def orm_delete_rendered_subscription(session: AsyncSession, user_id: UUID):
+    await session.execute(delete(RenderedSubscription).where(RenderedSubscription.user_id == user_id))
+    await session.commit()
+
+
+async def orm_get_users_to_prerender(session: AsyncSession, rendered_before: datetime):
+    '''Активные пользователи без готовой подписки или с подпиской, собранной раньше rendered_before'''
+    query = (
+        select(User)
+        .outerjoin(RenderedSubscription, RenderedSubscription.user_id == User.id)
+        .where(User.sub_end > datetime.now())
+        .where(
+            (RenderedSubscription.user_id == None) | (RenderedSubscription.updated < rendered_before)
+        )
+    )
+    result = await session.execute(query)
+    return result.scalars().all()
 
 
 # User
@@ -15,19 +104,15 @@ async def orm_add_user(
     telegram_id: int,
     invited_by: Optional[int] = None,
 ):
-    "Add new user to database if not exist"
-    query = select(User).where(User.telegram_id == telegram_id)
-    result = await session.execute(query)
-    
-    if result.first() is None:
-        session.add(User(
-            name=name,
-            telegram_id=telegram_id,
-            invited_by=invited_by
-        ))
-        await session.commit()
-    elif invited_by:
-        query = update(User).where(User.telegram_id==telegram_id).values(invited_by=invited_by)
+    "Add new user to database if not exist (one INSERT ... ON CONFLICT)"
+    # Существующего пользователя не трогаем: пригласивший записывается только при регистрации
+    query = insert(User).values(
+        name=name,
+        telegram_id=telegram_id,
+        invited_by=invited_by
+    ).on_conflict_do_nothing(index_elements=[User.telegram_id])
+    await session.execute(query)
+    await session.commit()
 
 
 async def orm_update_user(
@@ -39,6 +124,7 @@ async def orm_update_user(
         **data
     )
     await session.execute(query)
+    await _invalidate_subscriptions(session, user_id)
     await session.commit()
 
 
@@ -65,6 +151,7 @@ async def orm_change_user_tariff(
                 tun_id=key
             ))
 
+    await _invalidate_subscriptions(session, user_id)
     await session.commit()
 
 
@@ -98,6 +185,105 @@ async def orm_get_user_by_tgid(session: AsyncSession, telegram_id: int):
     return result.scalar()
 
 
+async def _stream_chunks(session: AsyncSession, query):
+    '''
+    Читает выборку серверным курсором пачками по DB_STREAM_CHUNK строк.
+    Пока идет чтение, соединение сессии занято - писать в БД нужно через другую сессию
+    '''
+    result = await session.stream(query.execution_options(yield_per=DB_STREAM_CHUNK))
+    async for chunk in result.partitions():
+        yield chunk
+
+
+async def _stream_rows(session: AsyncSession, query):
+    async for chunk in _stream_chunks(session, query):
+        for row in chunk:
+            yield row
+
+
+def orm_stream_user_contacts(session: AsyncSession, subscribers_only: bool = False):
+    '''Строки (telegram_id,) всех пользователей или только подписчиков - для рассылки'''
+    query = select(User.telegram_id)
+    if subscribers_only:
+        query = query.where(User.tariff_id > 0)
+    return _stream_rows(session, query)
+
+
+def _stream_sub_end_buckets(session: AsyncSession, buckets: dict, *where):
+    '''
+    Строки (telegram_id, name, sub_end, bucket) пользователей, попавших в одно из условий buckets
+    ({метка: условие на sub_end}). Диапазоны по sub_end читаются по индексу ix_users_sub_end
+    '''
+    bucket = case(*[(condition, key) for key, condition in buckets.items()]).label('bucket')
+    query = (
+        select(User.telegram_id, User.name, User.sub_end, bucket)
+        .where(or_(*buckets.values()))
+        .where(*where)
+    )
+    return _stream_rows(session, query)
+
+
+def orm_stream_expiring_users(session: AsyncSession, today: datetime, days: tuple[int, ...] = (3, 1, 0)):
+    '''Пользователи без автопродления, у которых (sub_end - today).days равно одному из days; bucket - число дней'''
+    buckets = {
+        day: (User.sub_end >= today + timedelta(days=day)) & (User.sub_end < today + timedelta(days=day + 1))
+        for day in days
+    }
+    return _stream_sub_end_buckets(session, buckets, or_(User.tariff_id == None, User.tariff_id <= 0))
+
+
+def orm_stream_expired_users(session: AsyncSession, today: datetime, days: tuple[int, ...] = (5, 15, 30)):
+    '''Пользователи, у которых (today - sub_end).days равно одному из days; bucket - число дней'''
+    buckets = {
+        day: (User.sub_end > today - timedelta(days=day + 1)) & (User.sub_end <= today - timedelta(days=day))
+        for day in days
+    }
+    return _stream_sub_end_buckets(session, buckets)
+
+
+def orm_stream_user_servers(
+    session: AsyncSession,
+    server_ids: Optional[list[int]] = None,
+    active_only: bool = False,
+    subscribers_only: bool = False
+):
+    '''
+    Строки (id, tun_id, server_id, name, telegram_id, sub_end, ips, trafic) - связь пользователь-сервер
+    вместе с нужными полями пользователя и тарифа, одним запросом
+    '''
+    query = (
+        select(
+            UserServer.id,
+            UserServer.tun_id,
+            UserServer.server_id,
+            User.name,
+            User.telegram_id,
+            User.sub_end,
+            Tariff.ips,
+            Tariff.trafic
+        )
+        .join(User, User.id == UserServer.user_id)
+        .outerjoin(Tariff, Tariff.id == User.tariff_id)
+    )
+    if server_ids is not None:
+        query = query.where(UserServer.server_id.in_(server_ids))
+    if active_only:
+        query = query.where(User.sub_end >= datetime.now())
+    if subscribers_only:
+        query = query.where(User.tariff_id > 0).where(Tariff.id != None)
+    return _stream_rows(session, query)
+
+
+def orm_stream_users_to_provision(session: AsyncSession):
+    '''Пачки строк (id, name, telegram_id, ips, sub_end, trafic) пользователей с подпиской - для нового сервера'''
+    query = (
+        select(User.id, User.name, User.telegram_id, User.ips, User.sub_end, Tariff.trafic)
+        .outerjoin(Tariff, Tariff.id == User.tariff_id)
+        .where(User.sub_end != None)
+    )
+    return _stream_chunks(session, query)
+
+
 # Server
 async def orm_add_server(
     session: AsyncSession,
@@ -108,21 +294,28 @@ async def orm_add_server(
     password: str,
     need_gb: bool = False
 ):
-    session.add(Server(
+    '''Добавляет сервер и возвращает его (INSERT ... RETURNING)'''
+    query = insert(Server).values(
         name=name,
         url=url,
         indoub_id=indoub_id,
         login=login,
         password=password,
         need_gb=need_gb
-    ))
+    ).returning(Server)
+    server = (await session.scalars(query)).one()
+    await _invalidate_subscriptions(session)
     await session.commit()
+    return server
 
 
 async def orm_delete_server(session: AsyncSession, server_id: int):
+    await session.execute(delete(InboundProfile).where(InboundProfile.server_id == server_id))
     query = delete(Server).where(Server.id == server_id)
     await session.execute(query)
+    await _invalidate_subscriptions(session)
     await session.commit()
+    panel_registry.invalidate(server_id)
 
 
 async def orm_update_server(
@@ -132,7 +325,9 @@ async def orm_update_server(
 ):
     query = update(Server).where(Server.id == server_id).values(**data)
     await session.execute(query)
+    await _invalidate_subscriptions(session)
     await session.commit()
+    panel_registry.invalidate(server_id)
 
 
 async def orm_get_servers(session: AsyncSession):
@@ -153,6 +348,44 @@ async def orm_get_server_by_ui(session: AsyncSession, url: str, indoub_id: int):
     return result.scalar()
 
 
+# InboundProfile
+async def orm_get_inbound_profiles(session: AsyncSession) -> dict[int, InboundProfile]:
+    '''Возвращает профили индаубов по id сервера'''
+    query = select(InboundProfile)
+    result = await session.execute(query)
+    return {profile.server_id: profile for profile in result.scalars().all()}
+
+
+async def orm_save_inbound_profile(
+    session: AsyncSession,
+    server_id: int,
+    profile: str,
+    link_template: str
+):
+    '''Сохраняет профиль индауба сервера. Возвращает True, если шаблон ссылки изменился'''
+    old = await session.get(InboundProfile, server_id)
+    changed = old is None or old.link_template != link_template
+
+    query = insert(InboundProfile).values(
+        server_id=server_id,
+        profile=profile,
+        link_template=link_template
+    )
+    query = query.on_conflict_do_update(
+        index_elements=[InboundProfile.server_id],
+        set_={
+            'profile': query.excluded.profile,
+            'link_template': query.excluded.link_template,
+            'updated': func.now()
+        }
+    )
+    await session.execute(query)
+    if changed:
+        await _invalidate_subscriptions(session)
+    await session.commit()
+    return changed
+
+
 # UserServer
 async def orm_add_user_server(
     session: AsyncSession,
@@ -160,12 +393,30 @@ async def orm_add_user_server(
     user_id: UUID,
     server_id: int
 ):
-    session.add(UserServer(
+    '''Добавляет связь пользователь-сервер и возвращает ее с id (INSERT ... RETURNING)'''
+    query = insert(UserServer).values(
         tun_id=tun_id,
         user_id=user_id,
         server_id=server_id
-    ))
+    ).returning(UserServer)
+    obj = (await session.scalars(query)).one()
+    await _invalidate_subscriptions(session, user_id)
+    await session.commit()
+    return obj
+
+
+async def orm_add_user_servers(session: AsyncSession, user_servers: list[dict]) -> list[UserServer]:
+    '''
+    Добавляет несколько связей пользователь-сервер одним коммитом и возвращает их с id.
+    Сбрасываются готовые подписки только этих пользователей
+    '''
+    if not user_servers:
+        return []
+    query = insert(UserServer).returning(UserServer, sort_by_parameter_order=True)
+    objs = (await session.scalars(query, user_servers)).all()
+    await _invalidate_users_subscriptions(session, [obj.user_id for obj in objs])
     await session.commit()
+    return objs
 
 
 async def orm_get_user_servers(session: AsyncSession, user_id: UUID):
@@ -187,8 +438,19 @@ async def orm_get_user_server_by_ti(session: AsyncSession, tun_id: str):
 
 
 async def orm_delete_user_servers(session: AsyncSession, tun_id: str):
-    query = delete(UserServer).where(UserServer.tun_id == tun_id)
-    await session.execute(query)
+    query = delete(UserServer).where(UserServer.tun_id == tun_id).returning(UserServer.user_id)
+    user_ids = (await session.scalars(query)).all()
+    await _invalidate_users_subscriptions(session, user_ids)
+    await session.commit()
+
+
+async def orm_delete_user_servers_by_ids(session: AsyncSession, ids: list[int]):
+    '''Удаляет связи пользователь-сервер по id - например, клиентов, которых не удалось создать на панели'''
+    if not ids:
+        return
+    query = delete(UserServer).where(UserServer.id.in_(ids)).returning(UserServer.user_id)
+    user_ids = (await session.scalars(query)).all()
+    await _invalidate_users_subscriptions(session, user_ids)
     await session.commit()
 
 
@@ -201,6 +463,7 @@ async def orm_get_user_servers_by_si(session: AsyncSession, server_id: int):
 async def orm_delete_user_servers_by_si(session: AsyncSession, server_id: str):
     query = delete(UserServer).where(UserServer.server_id == server_id)
     await session.execute(query)
+    await _invalidate_subscriptions(session)
     await session.commit()
 
 
@@ -299,36 +562,78 @@ async def orm_edit_faq(session: AsyncSession, id: int, fields: dict):
 
 # Payment
 async def orm_end_payment(session: AsyncSession, id: int):
-    query = update(Payment).where(Payment.id == id).values(paid = True)
+    '''Доступ по платежу выдан'''
+    query = update(Payment).where(Payment.id == id).values(status=Payment.PROVISIONED)
     await session.execute(query)
     await session.commit()
 
 
 async def orm_new_payment(session: AsyncSession, user_id: UUID, tariff_id: int, recurent: bool = False):
-    '''Создает новую запись о платеже в таблицу'''
-    obj = Payment(
+    '''Создает новую запись о платеже в таблицу и возвращает ее id - он же номер счета'''
+    query = insert(Payment).values(
         user_id=user_id,
         tariff_id=tariff_id,
         recurent=recurent,
-    )
-    session.add(obj)
+    ).returning(Payment.id)
+    payment_id = await session.scalar(query)
     await session.commit()
+    return payment_id
 
 
-async def orm_get_payment(session: AsyncSession, payment_id):
-    '''Возвращает запись о платеже по id'''
-    query = select(Payment).options(selectinload(Payment.user)).where(Payment.id == payment_id)
+async def orm_new_payments(session: AsyncSession, payments: list[dict]) -> list[int]:
+    '''Создает несколько платежей одним INSERT ... RETURNING и возвращает их id в том же порядке'''
+    if not payments:
+        return []
+    query = insert(Payment).returning(Payment.id, sort_by_parameter_order=True)
+    payment_ids = (await session.scalars(query, payments)).all()
+    await session.commit()
+    return list(payment_ids)
+
+
+async def orm_get_due_subscribers(session: AsyncSession, due_before: datetime):
+    '''
+    Подписчики с автопродлением, у которых подписка закончилась к due_before.
+    Строки (id, telegram_id, name, tariff_id, price, last_payment) - тариф и последний оплаченный
+    первичный платеж присоединены в том же запросе; last_payment равен None, если такого платежа нет.
+    Брошенные счета (pending) не берутся; счета до очереди выдачи доступа (legacy) - только если
+    оплаченных после нее нет
+    '''
+    def last_with_status(*statuses):
+        return (
+            select(func.max(Payment.id))
+            .where(Payment.user_id == User.id)
+            .where(Payment.recurent == False)
+            .where(Payment.status.in_(statuses))
+            .correlate(User)
+            .scalar_subquery()
+        )
+
+    last_payment = func.coalesce(
+        last_with_status(Payment.PAID, Payment.PROVISIONED),
+        last_with_status(Payment.LEGACY)
+    ).label('last_payment')
+    query = (
+        select(User.id, User.telegram_id, User.name, User.tariff_id, Tariff.price, last_payment)
+        .join(Tariff, Tariff.id == User.tariff_id)
+        .where(User.tariff_id > 0)
+        .where(User.sub_end <= due_before)
+    )
     result = await session.execute(query)
-    return result.scalar()
+    return result.all()
 
 
-async def orm_get_last_payment_id(session: AsyncSession):
-    '''Возвращает последнюю запись о платеже'''
-    query = select(Payment).order_by(Payment.id.desc()).limit(1)
+async def orm_get_payment(session: AsyncSession, payment_id):
+    '''Возвращает запись о платеже по id'''
+    query = (
+        select(Payment)
+        .options(
+            selectinload(Payment.user).selectinload(User.servers),
+            selectinload(Payment.tariff)
+        )
+        .where(Payment.id == payment_id)
+    )
     result = await session.execute(query)
-    payment = result.scalar_one_or_none()
-    
-    return payment.id if payment else 0
+    return result.scalar()
 
 
 async def orm_get_last_payment(session: AsyncSession, user_id: UUID):
@@ -340,3 +645,89 @@ async def orm_get_last_payment(session: AsyncSession, user_id: UUID):
     return payment.id if payment else 0
 
 
+# ProvisioningJob
+async def orm_claim_payment(session: AsyncSession, payment_id: int, email: Optional[str] = None) -> Optional[str]:
+    '''
+    Атомарно принимает callback по счету (UPDATE ... WHERE status IN (pending, legacy) RETURNING):
+    pending -> paid, и в той же транзакции выдача доступа ставится в очередь;
+    legacy -> review, доступ автоматически не выдается - счет проверяет администратор.
+    Возвращает новый статус (paid или review), если callback принят сейчас, пустую строку,
+    если счет уже был принят раньше (повторный callback), None - платежа нет
+    '''
+    claim = (
+        update(Payment)
+        .where(Payment.id == payment_id)
+        .where(Payment.status.in_([Payment.PENDING, Payment.LEGACY]))
+        .values(
+            status=case((Payment.status == Payment.PENDING, Payment.PAID), else_=Payment.REVIEW),
+            updated=datetime.now()
+        )
+        .returning(Payment.status)
+        .execution_options(synchronize_session=False)
+    )
+    status = (await session.execute(claim)).scalar()
+    if status is None:
+        await session.rollback()
+        exists = await session.scalar(select(Payment.id).where(Payment.id == payment_id))
+        return None if exists is None else ''
+    if status == Payment.REVIEW:
+        await session.commit()
+        return status
+
+    query = insert(ProvisioningJob).values(
+        payment_id=payment_id,
+        email=email,
+        next_attempt_at=datetime.now()
+    ).on_conflict_do_nothing(index_elements=[ProvisioningJob.payment_id])
+    await session.execute(query)
+    await session.commit()
+    return status
+
+
+async def orm_claim_provisioning_jobs(session: AsyncSession, limit: int, lease_seconds: float):
+    '''
+    Забирает до limit готовых к выполнению задач (и задачи, зависшие в processing дольше lease_seconds).
+    FOR UPDATE SKIP LOCKED - параллельные обработчики не получат одну задачу дважды.
+    Строки (id, payment_id, email, attempts, sub_end, notified, user_id)
+    '''
+    now = datetime.now()
+    due = (
+        select(ProvisioningJob.id)
+        .where(or_(
+            (ProvisioningJob.status == 'pending') & (ProvisioningJob.next_attempt_at <= now),
+            (ProvisioningJob.status == 'processing') & (ProvisioningJob.updated < now - timedelta(seconds=lease_seconds))
+        ))
+        .order_by(ProvisioningJob.next_attempt_at)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+    query = (
+        update(ProvisioningJob)
+        .where(ProvisioningJob.id.in_(due))
+        .where(Payment.id == ProvisioningJob.payment_id)
+        .values(status='processing', attempts=ProvisioningJob.attempts + 1, updated=now)
+        .returning(
+            ProvisioningJob.id,
+            ProvisioningJob.payment_id,
+            ProvisioningJob.email,
+            ProvisioningJob.attempts,
+            ProvisioningJob.sub_end,
+            ProvisioningJob.notified,
+            Payment.user_id
+        )
+        .execution_options(synchronize_session=False)
+    )
+    jobs = (await session.execute(query)).all()
+    await session.commit()
+    return jobs
+
+
+async def orm_update_provisioning_job(session: AsyncSession, job_id: int, **values):
+    query = (
+        update(ProvisioningJob)
+        .where(ProvisioningJob.id == job_id)
+        .values(updated=datetime.now(), **values)
+        .execution_options(synchronize_session=False)
+    )
+    await session.execute(query)
+    await session.commit()
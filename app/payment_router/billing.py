@@ -0,0 +1,104 @@
+import os
+import asyncio
+import hashlib
+from datetime import date, datetime, time
+
+from aiogram import Bot
+from httpx import AsyncClient, Limits, Timeout
+
+from app.database.engine import async_session_maker
+from app.database.queries import orm_get_due_subscribers, orm_new_payments
+from app.setup_logger import logger
+
+
+ROBOKASSA_RECURRING_URL = 'https://auth.robokassa.ru/Merchant/Recurring'
+# Сколько запросов Recurring отправляем одновременно и сколько ждем ответа на каждый
+BILLING_CONCURRENCY = int(os.getenv("BILLING_CONCURRENCY", 10))
+BILLING_TIMEOUT = float(os.getenv("BILLING_TIMEOUT", 30))
+
+
+def _signature(price, invoice_id: int) -> str:
+    base_string = f"{os.getenv('SHOP_ID')}:{price}:{invoice_id}:{os.getenv('PASSWORD_1')}"
+    return hashlib.md5(base_string.encode("utf-8")).hexdigest()
+
+
+async def _charge(client: AsyncClient, semaphore: asyncio.Semaphore, bot: Bot, user, invoice_id: int) -> dict:
+    """Один запрос Recurring. Возвращает запись о результате для пользователя"""
+    result = {'telegram_id': user.telegram_id, 'invoice_id': invoice_id, 'ok': False, 'error': None}
+
+    async with semaphore:
+        try:
+            response = await client.post(
+                ROBOKASSA_RECURRING_URL,
+                data={
+                    "MerchantLogin": os.getenv('SHOP_ID'),
+                    "InvoiceID": invoice_id,
+                    "PreviousInvoiceID": int(user.last_payment),
+                    "Description": "Автопродление подписки SkynetVPN",
+                    "SignatureValue": _signature(user.price, invoice_id),
+                    "OutSum": float(user.price),
+                }
+            )
+        except Exception as e:
+            logger.error(f"Ошибка автопродления для {user.telegram_id}: {e}")
+            result['error'] = str(e)
+            return result
+
+    logger.info(f"Robokassa ответ для {user.telegram_id}: {response.status_code} - {response.text}")
+    if response.status_code == 200:
+        # Robokassa приняла запрос, ждём callback на /payment/get_payment
+        logger.info(f"Запрос на автопродление отправлен для {user.telegram_id}")
+        result['ok'] = True
+        return result
+
+    logger.error(f"Ошибка Robokassa: {response.text}")
+    result['error'] = f"{response.status_code}: {response.text}"
+    try:
+        await bot.send_message(
+            user.telegram_id,
+            "⚠️ Не удалось автоматически продлить подписку. "
+            "Пожалуйста, продлите вручную: /start → Купить подписку"
+        )
+    except Exception as e:
+        logger.warning(f"Не удалось отправить уведомление {user.telegram_id}: {e}")
+    return result
+
+
+async def run_recurring_billing(bot: Bot) -> list[dict]:
+    """
+    Автопродление: должники выбираются одним запросом вместе с тарифом и последним первичным платежом,
+    счета создаются одним INSERT, запросы Recurring идут параллельно (не больше BILLING_CONCURRENCY)
+    через общий клиент. Возвращает записи о результате по каждому пользователю
+    """
+    today = datetime.combine(date.today(), time.min)
+
+    async with async_session_maker() as session:
+        users = []
+        for user in await orm_get_due_subscribers(session, today):
+            if user.last_payment is None:
+                logger.warning(f"Нет предыдущего платежа для {user.telegram_id}")
+                continue
+            logger.info(f"Автопродление для {user.name} (tg:{user.telegram_id})")
+            users.append(user)
+
+        invoice_ids = await orm_new_payments(session, [
+            {'user_id': user.id, 'tariff_id': user.tariff_id, 'recurent': True}
+            for user in users
+        ])
+
+    if not users:
+        return []
+
+    semaphore = asyncio.Semaphore(BILLING_CONCURRENCY)
+    async with AsyncClient(
+        timeout=Timeout(BILLING_TIMEOUT),
+        limits=Limits(max_connections=BILLING_CONCURRENCY, max_keepalive_connections=BILLING_CONCURRENCY)
+    ) as client:
+        results = await asyncio.gather(*(
+            _charge(client, semaphore, bot, user, invoice_id)
+            for user, invoice_id in zip(users, invoice_ids)
+        ))
+
+    succeeded = sum(result['ok'] for result in results)
+    logger.info(f"Автопродление завершено: отправлено {succeeded} из {len(results)}")
+    return results
@@ -3,40 +3,35 @@ import os
 import json
 import hashlib
 from typing import Union
-from uuid import UUID, uuid4
+from uuid import UUID
 
 from aiogram import Bot
-from dateutil.relativedelta import relativedelta
 from fastapi import APIRouter, Depends, Form, HTTPException, Request 
 from fastapi.templating import Jinja2Templates
 from starlette.responses import FileResponse, HTMLResponse
 from sqlalchemy.ext.asyncio import AsyncSession
-from httpx import AsyncClient
 
-from app.tg_bot_router.kbds.inline import succes_pay_btns
 from app.utils.days_to_month import days_to_str
 from app.database.engine import get_async_session, async_session_maker
+from app.database.models import Payment
 from app.setup_logger import logger
 from app.tg_bot_router.bot import bot
 from app.database.queries import (
-    orm_add_user_server,
-    orm_change_user_tariff,
-    orm_get_last_payment,
+    orm_claim_payment,
+    orm_get_admins,
     orm_get_payment,
-    orm_get_server,
     orm_get_servers,
     orm_get_tariff,
-    orm_get_last_payment_id,
     orm_get_user,
     orm_get_user_by_tgid,
-    orm_get_user_server,
-    orm_get_user_server_by_ti,
-    orm_get_user_servers,
     orm_new_payment,
-    orm_update_user,
-    orm_get_subscribers, orm_get_users
+    orm_stream_user_servers,
+    orm_stream_expired_users,
+    orm_stream_expiring_users
 )
-from app.utils.three_x_ui_api import ThreeXUIServer
+from app.payment_router.billing import run_recurring_billing
+from app.payment_router.provisioning import wake_provisioning
+from app.utils.panel_registry import panel_registry
 
 
 payment_router = APIRouter(prefix="/payment")
@@ -54,7 +49,7 @@ async def payment_page(
     user = await orm_get_user_by_tgid(session, telegram_id=telegram_id)
     if not tariff or not user:
         raise HTTPException(status_code=404, detail="Tariff or User not found")
-    invoice_id = await orm_get_last_payment_id(session) + 1
+    invoice_id = await orm_new_payment(session, tariff_id=tariff.id, user_id=user.id)
 
     receipt =  {
           "sno":"patent",
@@ -73,7 +68,6 @@ async def payment_page(
     print(json.dumps(receipt, ensure_ascii=False))
     base_string = f"{os.getenv('SHOP_ID')}:{tariff.price}:{invoice_id}:{json.dumps(receipt, ensure_ascii=False)}:{os.getenv('PASSWORD_1')}"
     signature_value = hashlib.md5(base_string.encode("utf-8")).hexdigest()
-    await orm_new_payment(session, tariff_id=tariff.id, user_id=user.id)
 
     return templates.TemplateResponse(
     "/payment_page.html", 
@@ -90,6 +84,27 @@ async def payment_page(
     )
 
 
+async def _report_legacy_payment(session: AsyncSession, payment_id: int, out_sum):
+    """
+    Callback по счету, выставленному до очереди выдачи доступа: это может быть повтор уже обработанного
+    платежа или оплата старого счета. Автоматически доступ не выдается - решает администратор
+    """
+    logger.warning(f"Callback по старому счету {payment_id}, требуется проверка")
+    payment = await orm_get_payment(session, payment_id)
+    user = payment.user if payment else None
+    text = (
+        f"⚠️ Пришла оплата по старому счету {payment_id} на {out_sum}₽\n"
+        f"Пользователь: {user.name if user else '-'} (tg:{user.telegram_id if user else '-'})\n\n"
+        f"Счет выставлен до обновления, поэтому доступ автоматически не выдан: это может быть "
+        f"повтор уже обработанного платежа. Проверьте платеж в Robokassa и при необходимости выдайте доступ вручную"
+    )
+    for admin in await orm_get_admins(session):
+        try:
+            await bot.send_message(admin.telegram_id, text)
+        except Exception as e:
+            logger.warning(f"Не удалось отправить сообщение администратору {admin.telegram_id}: {e}")
+
+
 @payment_router.post("/get_payment")
 async def choose_server(
         OutSum: Union[str, float, int] = Form(...),
@@ -102,136 +117,18 @@ async def choose_server(
         Shp_Receipt: Union[str, None] = Form(None),
         session: AsyncSession = Depends(get_async_session)
     ):
-    payment = await orm_get_payment(session, int(InvId))
-    if not payment:
+    # Выдача доступа выполняется в фоне (provisioning.py): Robokassa получает ответ сразу.
+    # Счет принимается один раз - повторный callback отвечает OK без работы с БД и панелями
+    claimed = await orm_claim_payment(session, int(InvId), EMail)
+    if claimed is None:
         raise HTTPException(status_code=404, detail="Оплата не найдена")
-
-    user = payment.user
-
-    try:
-        await orm_update_user(session, user.id, {'email': EMail})
-    except:
-        logger.error("Не удалось сменить почту пользователя")
-
-    tariff = await orm_get_tariff(session, payment.tariff_id)
-    user_servers = await orm_get_user_servers(session, user.id)
-    servers = await orm_get_servers(session)
-    threex_panels = []
-    for i in servers:
-        threex_panels.append(ThreeXUIServer(
-            i.id,
-            i.url,
-            i.indoub_id,
-            i.login,
-            i.password,
-            i.need_gb
-        ))
-
-    if not payment.recurent:
-
-        if not user_servers:
-            today_datetime = datetime.combine(date.today(), time.min)
-            end_datetime = today_datetime + relativedelta(days=tariff.days)
-            end_timestamp = int(end_datetime.timestamp() * 1000)
-
-            for i in threex_panels:
-                uuid = uuid4()
-                await orm_add_user_server(
-                    session, 
-                    server_id=i.id,
-                    tun_id = str(uuid),
-                    user_id = user.id,
-                )
-                user_server = await orm_get_user_server_by_ti(session, str(uuid))
-                server = await orm_get_server(session, user_server.server_id)
-                await i.add_client(
-                    uuid=str(uuid),
-                    email=server.name + '_' + str(user_server.id),
-                    limit_ip=tariff.ips,
-                    expiry_time=end_timestamp,
-                    tg_id=user.telegram_id,
-                    name=user.name,
-                    total_gb=30 if i.need_gb else 0
-                )
-            
-            await orm_change_user_tariff(
-                session, 
-                tariff_id=tariff.id,
-                user_id=user.id,
-                sub_end=end_datetime
-            )
-
-        else:
-            today_datetime = datetime.combine(date.today(), time.min)
-            if user.sub_end > today_datetime:
-                end_datetime = user.sub_end + relativedelta(days=tariff.days)
-            else:
-                end_datetime = today_datetime + relativedelta(days=tariff.days)
-            end_timestamp = int(end_datetime.timestamp() * 1000)
-
-            for i in threex_panels:
-                user_server = await orm_get_user_server(session, user.id, i.id)
-                server = await orm_get_server(session, user_server.server_id)
-                await i.edit_client(
-                    uuid=user_server.tun_id,
-                    email=server.name + '_' + str(user_server.id),
-                    limit_ip=tariff.ips,
-                    name=user.name,
-                    expiry_time=end_timestamp,
-                    tg_id=user.telegram_id,
-                    total_gb=tariff.trafic if i.need_gb else 0
-                )
-            
-            await orm_change_user_tariff(
-                session, 
-                tariff_id=tariff.id,
-                user_id=user.id,
-                sub_end=end_datetime
-            )
-
-        url = f"{os.getenv('URL')}/api/subscribtion?user_token={user.id}"
-            
-        await bot.send_message(
-            user.telegram_id, 
-            f"<b>✅ Спасибо! Вы оформили подписку!</b>\n\n🗓 Ваша подписка активна до {user.sub_end.date().strftime('%d.%m.%Y')}\n\n<b>Для автоматического подключения нажмите кнопку \"Подключиться\"\n\nДля ручного ввода скопируйте ключ. Для копирования ключа нажмите на него 1 раз. ⬇️</b>\n<code>{url}</code>",
-            reply_markup=succes_pay_btns(user)
-        )
-        
+    if claimed == Payment.PAID:
+        wake_provisioning()
+    elif claimed == Payment.REVIEW:
+        await _report_legacy_payment(session, int(InvId), OutSum)
     else:
-        today_datetime = datetime.combine(date.today(), time.min)
-        end_datetime = today_datetime + relativedelta(days=tariff.days)
-        end_timestamp = int(end_datetime.timestamp() * 1000)
-
-        for i in threex_panels:
-            user_server = await orm_get_user_server(session, user.id, i.id)
-            await i.edit_client(
-                uuid=user_server.tun_id,
-                email=user.name,
-                limit_ip=tariff.ips,
-                expiry_time=end_timestamp,
-                tg_id=user.telegram_id,
-                name=user.name,
-                total_gb=tariff.trafic if i.need_gb else 0
-            )
-        
-        await orm_change_user_tariff(
-            session, 
-            tariff_id=tariff.id,
-            user_id=user.id,
-            sub_end=end_datetime
-        )
-
-        url = f"{os.getenv('URL')}/api/get_sub?user_token={user.id}"
-        await bot.send_message(
-            user.telegram_id,
-            f"<b>🔄 Ваша подписка успешно продлена!</b>\n\n"
-            f"🗓 Подписка активна до {end_datetime.strftime('%d.%m.%Y')}\n"
-            f"💰 Сумма списания: {tariff.price}₽\n\n"
-            f"<b>Для автоматического подключения нажмите кнопку \"Подключиться\"\n\n"
-            f"Для ручного ввода скопируйте ключ. Для копирования ключа нажмите на него 1 раз. ⬇️</b>\n"
-            f"<code>{url}</code>",
-            reply_markup=succes_pay_btns(user),
-        )
+        logger.info(f"Повторный callback по счету {InvId}")
+
     return f'OK{InvId}'
 
 
@@ -243,18 +140,11 @@ async def check_subscription_expiry(bot: Bot):
     - После окончания подписки
     """
     async with async_session_maker() as session:
-        users = await orm_get_users(session)
         today = datetime.combine(date.today(), time.min)
 
-        for user in users:
-            if not user.sub_end:
-                continue
-
-            # Пропускаем активных подписчиков (с автопродлением)
-            if user.tariff_id and user.tariff_id > 0:
-                continue
-
-            days_left = (user.sub_end - today).days
+        # Только пользователи без автопродления, у которых до конца осталось 3, 1 или 0 дней
+        async for user in orm_stream_expiring_users(session, today, days=(3, 1, 0)):
+            days_left = user.bucket
 
             try:
                 if days_left == 3:
@@ -292,98 +182,16 @@ async def check_subscription_expiry(bot: Bot):
 
 async def recurent_payment(bot: Bot):
     """Автоматическое продление подписок через Robokassa"""
-    async with async_session_maker() as session:
-        users = await orm_get_subscribers(session)
-        today = datetime.combine(date.today(), time.min)
-
-        for user in users:
-            # Проверяем: tariff_id > 0 и подписка истекла
-            if user.tariff_id != 0 and user.sub_end and user.sub_end <= today:
-                logger.info(f"Автопродление для {user.name} (tg:{user.telegram_id})")
-
-                # Получаем последний НЕрекуррентный платёж (первичный)
-                last_payment = await orm_get_last_payment(session, user.id)
-                if not last_payment:
-                    logger.warning(f"Нет предыдущего платежа для {user.telegram_id}")
-                    continue
-
-                tariff = await orm_get_tariff(session, tariff_id=user.tariff_id)
-                if not tariff:
-                    logger.warning(f"Тариф {user.tariff_id} не найден")
-                    continue
-
-                # Создаём новый рекуррентный платёж
-                await orm_new_payment(
-                    session,
-                    tariff_id=user.tariff_id,
-                    user_id=user.id,
-                    recurent=True
-                )
-                invoice_id = await orm_get_last_payment_id(session)
-
-                receipt = {
-                    "sno": "patent",
-                    "items": [
-                        {
-                            "name": f"Подписка SkynetVPN на {days_to_str(tariff.days)}",
-                            "quantity": 1,
-                            "sum": float(tariff.price),
-                            "payment_method": "full_payment",
-                            "payment_object": "service",
-                            "tax": "vat10"
-                        },
-                    ]
-                }
-
-                # Подпись для рекуррентного платежа
-                base_string = f"{os.getenv('SHOP_ID')}:{tariff.price}:{invoice_id}:{os.getenv('PASSWORD_1')}"
-                signature_value = hashlib.md5(base_string.encode("utf-8")).hexdigest()
-
-                try:
-                    async with AsyncClient() as client:
-                        response = await client.post(
-                            'https://auth.robokassa.ru/Merchant/Recurring',
-                            data={
-                                "MerchantLogin": os.getenv('SHOP_ID'),
-                                "InvoiceID": int(invoice_id),
-                                "PreviousInvoiceID": int(last_payment),
-                                "Description": "Автопродление подписки SkynetVPN",
-                                "SignatureValue": signature_value,
-                                "OutSum": float(tariff.price),
-                            }
-                        )
-
-                        logger.info(f"Robokassa ответ для {user.telegram_id}: {response.status_code} - {response.text}")
-
-                        if response.status_code == 200:
-                            # Robokassa приняла запрос, ждём callback на /payment/get_payment
-                            logger.info(f"Запрос на автопродление отправлен для {user.telegram_id}")
-                        else:
-                            logger.error(f"Ошибка Robokassa: {response.text}")
-                            await bot.send_message(
-                                user.telegram_id,
-                                "⚠️ Не удалось автоматически продлить подписку. "
-                                "Пожалуйста, продлите вручную: /start → Купить подписку"
-                            )
-
-                except Exception as e:
-                    logger.error(f"Ошибка автопродления для {user.telegram_id}: {e}")
+    await run_recurring_billing(bot)
 
 
 async def reset_monthly_traffic(bot: Bot):
     """Ежемесячный сброс трафика на сервере обхода белых списков"""
     async with async_session_maker() as session:
-        users = await orm_get_users(session)
         servers = await orm_get_servers(session)
-        today = datetime.now()
 
         # Создаём панели только для need_gb серверов
-        panels = []
-        for s in servers:
-            if s.need_gb:
-                panels.append(ThreeXUIServer(
-                    s.id, s.url, s.indoub_id, s.login, s.password, s.need_gb, s.name
-                ))
+        panels = {panel.id: panel for panel in panel_registry.get_panels(s for s in servers if s.need_gb)}
 
         if not panels:
             logger.info("Нет серверов с need_gb для сброса трафика")
@@ -391,28 +199,18 @@ async def reset_monthly_traffic(bot: Bot):
 
         reset_count = 0
 
-        for user in users:
-            # Только активные подписчики
-            if not user.sub_end or user.sub_end < today:
-                continue
-
-            user_servers = await orm_get_user_servers(session, user.id)
-
-            for us in user_servers:
-                for panel in panels:
-                    if panel.id != us.server_id:
-                        continue
-
-                    try:
-                        # Формируем email как в других местах
-                        email = panel.name + '_' + str(us.id)
-                        result = await panel.reset_client_traffic(email)
-                        if result:
-                            reset_count += 1
-                            logger.info(f"Сброшен трафик для {user.name} на {panel.name}")
-                    except Exception as e:
-                        logger.error(f"Ошибка сброса трафика для {user.name}: {e}")
-                    break
+        # Только активные подписчики и только их записи на need_gb серверах
+        async for us in orm_stream_user_servers(session, server_ids=list(panels), active_only=True):
+            panel = panels[us.server_id]
+            try:
+                # Формируем email как в других местах
+                email = panel.name + '_' + str(us.id)
+                result = await panel.reset_client_traffic(email)
+                if result:
+                    reset_count += 1
+                    logger.info(f"Сброшен трафик для {us.name} на {panel.name}")
+            except Exception as e:
+                logger.error(f"Ошибка сброса трафика для {us.name}: {e}")
 
         logger.info(f"Ежемесячный сброс трафика завершён. Сброшено: {reset_count}")
 
@@ -420,18 +218,11 @@ async def reset_monthly_traffic(bot: Bot):
 async def notify_expired_users(bot: Bot):
     """Уведомления пользователям с истёкшей подпиской (5, 15, 30 дней)"""
     async with async_session_maker() as session:
-        users = await orm_get_users(session)
         today = datetime.combine(date.today(), time.min)
 
-        for user in users:
-            if not user.sub_end:
-                continue
-
-            # Только истёкшие подписки
-            if user.sub_end > today:
-                continue
-
-            days_expired = (today - user.sub_end).days
+        # Только подписки, истёкшие ровно 5, 15 или 30 дней назад
+        async for user in orm_stream_expired_users(session, today, days=(5, 15, 30)):
+            days_expired = user.bucket
 
             try:
                 if days_expired == 5:
@@ -0,0 +1,241 @@
+import os
+import asyncio
+from collections import defaultdict
+from datetime import date, datetime, time, timedelta
+from uuid import uuid4
+
+from aiogram import Bot
+from dateutil.relativedelta import relativedelta
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.database.engine import async_session_maker
+from app.database.queries import (
+    orm_add_user_servers,
+    orm_change_user_tariff,
+    orm_claim_provisioning_jobs,
+    orm_end_payment,
+    orm_get_admins,
+    orm_get_payment,
+    orm_get_servers,
+    orm_update_provisioning_job,
+    orm_update_user
+)
+from app.setup_logger import logger
+from app.tg_bot_router.kbds.inline import succes_pay_btns
+from app.utils.panel_registry import panel_registry
+from app.utils.sub_tokens import subscription_url
+from app.utils.three_x_ui_api import ThreeXUIServer
+
+
+# Как часто обработчик проверяет очередь, если его не разбудил callback
+PROVISIONING_INTERVAL = float(os.getenv("PROVISIONING_INTERVAL", 10))
+# Сколько задач берем за раз
+PROVISIONING_BATCH = int(os.getenv("PROVISIONING_BATCH", 20))
+# Попытки и пауза между ними: base * 2^(попытка-1), не больше max
+PROVISIONING_MAX_ATTEMPTS = int(os.getenv("PROVISIONING_MAX_ATTEMPTS", 10))
+PROVISIONING_RETRY_BASE = float(os.getenv("PROVISIONING_RETRY_BASE", 30))
+PROVISIONING_RETRY_MAX = float(os.getenv("PROVISIONING_RETRY_MAX", 3600))
+# Задача в processing дольше этого времени считается брошенной (процесс упал) и берется снова
+PROVISIONING_LEASE = float(os.getenv("PROVISIONING_LEASE", 600))
+
+_wakeup = asyncio.Event()
+
+
+class ProvisioningError(Exception):
+    pass
+
+
+def wake_provisioning():
+    """Будит обработчик очереди сразу после новой задачи"""
+    _wakeup.set()
+
+
+def _end_datetime(payment, user) -> datetime:
+    today_datetime = datetime.combine(date.today(), time.min)
+    if not payment.recurent and user.sub_end and user.sub_end > today_datetime:
+        return user.sub_end + relativedelta(days=payment.tariff.days)
+    return today_datetime + relativedelta(days=payment.tariff.days)
+
+
+async def _sync_client(panel: ThreeXUIServer, user, tariff, user_server, end_timestamp: int, new: bool) -> bool:
+    """Создает или продлевает клиента на одной панели. Повторный вызов безопасен"""
+    if not panel.available:
+        logger.error(f"Панель {panel.url} недоступна, клиент {user.name} не обновлен")
+        return False
+
+    client = {
+        'uuid': user_server.tun_id,
+        'email': panel.name + '_' + str(user_server.id),
+        'limit_ip': tariff.ips,
+        'expiry_time': end_timestamp,
+        'tg_id': user.telegram_id,
+        'name': user.name,
+    }
+    try:
+        if not new and await panel.edit_client(**client, total_gb=tariff.trafic if panel.need_gb else 0):
+            return True
+        # Новая запись или клиента нет на панели (прошлую попытку прервали до addClient)
+        return await panel.add_client(**client, total_gb=30 if panel.need_gb else 0)
+    except Exception as e:
+        logger.error(f"Ошибка выдачи доступа {user.name} на {panel.url}: {e}")
+        return False
+
+
+async def provision_payment(session: AsyncSession, bot: Bot, job, final: bool = False) -> None:
+    """
+    Выдает или продлевает доступ по оплаченному платежу на всех панелях.
+    Безопасна для повторов: дата окончания считается один раз и хранится в задаче,
+    клиенты создаются/изменяются идемпотентно, сообщение пользователю отправляется один раз -
+    когда обновлены все панели или это последняя попытка (final) и хотя бы одна панель обновлена.
+    Если какая-то панель не ответила - ProvisioningError, задача будет повторена
+    """
+    payment = await orm_get_payment(session, job.payment_id)
+    if not payment:
+        raise ProvisioningError("Оплата не найдена")
+
+    user, tariff = payment.user, payment.tariff
+
+    end_datetime = job.sub_end
+    if end_datetime is None:
+        end_datetime = _end_datetime(payment, user)
+        # Сначала фиксируем дату в задаче: повтор после сбоя не продлит подписку второй раз
+        await orm_update_provisioning_job(session, job.id, sub_end=end_datetime)
+        if job.email:
+            try:
+                await orm_update_user(session, user.id, {'email': job.email})
+            except Exception:
+                await session.rollback()
+                logger.error("Не удалось сменить почту пользователя")
+    await orm_change_user_tariff(
+        session,
+        tariff_id=tariff.id,
+        user_id=user.id,
+        sub_end=end_datetime
+    )
+
+    panels = panel_registry.get_panels(await orm_get_servers(session))
+    user_servers = {us.server_id: us for us in user.servers}
+    missing = [panel for panel in panels if panel.id not in user_servers]
+    created = await orm_add_user_servers(session, [
+        {'user_id': user.id, 'server_id': panel.id, 'tun_id': str(uuid4())}
+        for panel in missing
+    ])
+    user_servers.update({us.server_id: us for us in created})
+
+    # Панели обновляются параллельно, у каждой свой лимит одновременных запросов
+    end_timestamp = int(end_datetime.timestamp() * 1000)
+    results = await asyncio.gather(*(
+        _sync_client(panel, user, tariff, user_servers[panel.id], end_timestamp, new=panel in missing)
+        for panel in panels
+    ))
+
+    failed = [panel.url for panel, ok in zip(panels, results) if not ok]
+    if not job.notified and (not failed or (final and any(results))):
+        try:
+            await _notify_user(bot, payment, user, tariff, end_datetime)
+        except Exception as e:
+            logger.warning(f"Не удалось отправить сообщение об оплате {user.telegram_id}: {e}")
+        await orm_update_provisioning_job(session, job.id, notified=True)
+
+    if failed:
+        raise ProvisioningError(f"Не обновлены панели: {', '.join(failed)}")
+
+
+async def _notify_user(bot: Bot, payment, user, tariff, end_datetime: datetime):
+    url = subscription_url(user.id)
+    if not payment.recurent:
+        await bot.send_message(
+            user.telegram_id,
+            f"<b>✅ Спасибо! Вы оформили подписку!</b>\n\n🗓 Ваша подписка активна до {end_datetime.strftime('%d.%m.%Y')}\n\n<b>Для автоматического подключения нажмите кнопку \"Подключиться\"\n\nДля ручного ввода скопируйте ключ. Для копирования ключа нажмите на него 1 раз. ⬇️</b>\n<code>{url}</code>",
+            reply_markup=succes_pay_btns(user)
+        )
+    else:
+        await bot.send_message(
+            user.telegram_id,
+            f"<b>🔄 Ваша подписка успешно продлена!</b>\n\n"
+            f"🗓 Подписка активна до {end_datetime.strftime('%d.%m.%Y')}\n"
+            f"💰 Сумма списания: {tariff.price}₽\n\n"
+            f"<b>Для автоматического подключения нажмите кнопку \"Подключиться\"\n\n"
+            f"Для ручного ввода скопируйте ключ. Для копирования ключа нажмите на него 1 раз. ⬇️</b>\n"
+            f"<code>{url}</code>",
+            reply_markup=succes_pay_btns(user),
+        )
+
+
+async def _notify_admins(session: AsyncSession, bot: Bot, text: str):
+    for admin in await orm_get_admins(session):
+        try:
+            await bot.send_message(admin.telegram_id, text)
+        except Exception as e:
+            logger.warning(f"Не удалось отправить сообщение администратору {admin.telegram_id}: {e}")
+
+
+async def _run_job(bot: Bot, job):
+    async with async_session_maker() as session:
+        final = job.attempts >= PROVISIONING_MAX_ATTEMPTS
+        try:
+            await provision_payment(session, bot, job, final=final)
+        except Exception as e:
+            await session.rollback()
+            if final:
+                logger.error(f"Выдача доступа по платежу {job.payment_id} не удалась после {job.attempts} попыток: {e}")
+                await orm_update_provisioning_job(session, job.id, status='failed', last_error=str(e))
+                await _notify_admins(
+                    session,
+                    bot,
+                    f"❌ Не удалось выдать доступ по оплаченному платежу {job.payment_id} "
+                    f"после {job.attempts} попыток\n{e}\n\nПользователь оплатил подписку - проверьте панели"
+                )
+                return
+
+            delay = min(PROVISIONING_RETRY_MAX, PROVISIONING_RETRY_BASE * 2 ** (job.attempts - 1))
+            logger.warning(f"Выдача доступа по платежу {job.payment_id}, попытка {job.attempts}: {e}. Повтор через {delay:.0f} с")
+            await orm_update_provisioning_job(
+                session,
+                job.id,
+                status='pending',
+                last_error=str(e),
+                next_attempt_at=datetime.now() + timedelta(seconds=delay)
+            )
+            return
+
+        await orm_update_provisioning_job(session, job.id, status='done', last_error=None)
+        await orm_end_payment(session, job.payment_id)
+        logger.info(f"Доступ по платежу {job.payment_id} выдан")
+
+
+async def _run_user_jobs(bot: Bot, jobs: list):
+    # Платежи одного пользователя - по очереди, иначе оба продления посчитаются от одной даты
+    for job in sorted(jobs, key=lambda job: job.payment_id):
+        await _run_job(bot, job)
+
+
+async def process_provisioning_jobs(bot: Bot) -> int:
+    """Одна итерация: забирает готовые задачи и выполняет их параллельно. Возвращает число задач"""
+    async with async_session_maker() as session:
+        jobs = await orm_claim_provisioning_jobs(session, PROVISIONING_BATCH, PROVISIONING_LEASE)
+
+    by_user = defaultdict(list)
+    for job in jobs:
+        by_user[job.user_id].append(job)
+    await asyncio.gather(*(_run_user_jobs(bot, user_jobs) for user_jobs in by_user.values()))
+    return len(jobs)
+
+
+async def run_provisioning_worker(bot: Bot):
+    """Фоновый обработчик очереди выдачи доступа; запускается в lifespan"""
+    logger.info("Обработчик очереди выдачи доступа запущен")
+    while True:
+        try:
+            if await process_provisioning_jobs(bot) >= PROVISIONING_BATCH:
+                continue
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.error("Ошибка обработчика очереди выдачи доступа", exc_info=True)
+
+        try:
+            await asyncio.wait_for(_wakeup.wait(), timeout=PROVISIONING_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _wakeup.clear()
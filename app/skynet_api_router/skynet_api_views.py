@@ -1,8 +1,5 @@
-import base64
-from urllib.parse import quote
 from datetime import datetime
-from uuid import UUID
-from fastapi import APIRouter, Depends, HTTPException, Response
+from fastapi import APIRouter, Depends, Header, HTTPException, Request
 from sqlalchemy.ext.asyncio import AsyncSession
 from pydantic import BaseModel
 
@@ -10,9 +7,13 @@ from app.database.engine import get_async_session
 from app.utils.days_to_month import days_to_str
 from app.tg_bot_router.bot import bot
 from app.skynet_api_router.schemas import UpdateClientGS
-from app.setup_logger import logger
+from app.skynet_api_router.subscription import (
+    get_cached_subscription,
+    get_prerendered_subscription,
+    render_subscription,
+    subscription_version,
+)
 from app.database.queries import (
-    orm_get_server,
     orm_get_servers,
     orm_get_subscribers,
     orm_get_user_by_tgid,
@@ -23,7 +24,9 @@ from app.database.queries import (
     orm_get_admins,
     orm_update_user
 )
-from app.utils.three_x_ui_api import ThreeXUIServer
+from app.utils.panel_registry import panel_registry
+from app.utils.rate_limiter import check_rate_limit, too_many_requests
+from app.utils.sub_tokens import resolve_user_id
 
 
 api_router = APIRouter(prefix='/api')
@@ -80,17 +83,7 @@ async def update_clients(
     new_date = datetime(int(date[0]), int(date[1]), int(date[2])+1, now.hour, now.minute, now.second, now.microsecond)
     new_unix_date = int(new_date.timestamp() * 1000)
     
-    threex_panels = []
-    for i in servers:
-        threex_panels.append(ThreeXUIServer(
-            i.id,
-            i.url,
-            i.indoub_id,
-            i.login,
-            i.password,
-            i.need_gb,
-            i.name
-        ))
+    threex_panels = panel_registry.get_panels(servers)
     
     for server in user_servers:
         for panel in threex_panels:
@@ -117,88 +110,31 @@ async def update_clients(
 
 
 @api_router.get("/subscribtion")
-async def generate_subscription_config(user_token: str, session: AsyncSession = Depends(get_async_session)):
-    user = await orm_get_user(session, UUID(user_token))
-    if not user:
+async def generate_subscription_config(
+    user_token: str,
+    request: Request,
+    if_none_match: str | None = Header(None),
+    session: AsyncSession = Depends(get_async_session)
+):
+    # Поддельный или отозванный токен отклоняется без обращения к БД
+    user_id = resolve_user_id(user_token)
+    if user_id is None:
         raise HTTPException(status_code=404, detail="User not found")
 
-    today = datetime.now()
-
-    if not user.sub_end or user.sub_end < today:
-        response = Response(
-            content=(
-                f"vless://{user.id}@1.23.123.4:8452?"
-                f"type=tcp&spx=%2F&flow=#{quote('❌ Ваша подписка закончилась')}"
-            ),
-            media_type="text/plain; charset=utf-8"
-        )
-        response.headers['profile-title'] = "base64:" + base64.b64encode('⚡️ SkynetVPN'.encode('utf-8')).decode('latin-1')
-        response.headers["announce"] = "base64:" + base64.b64encode("🚀 Нажмите сюда, тут можно продлить подписку".encode('utf-8')).decode('latin-1')
-        response.headers["announce-url"] = "https://t.me/skynetaivpn_bot"
-        return response
-
-    user_servers = await orm_get_user_servers(session, user.id)
-    if not user_servers:
-        raise HTTPException(status_code=404, detail="No servers for user")
-
-    servers = await orm_get_servers(session)
-    threex_panels = [
-        ThreeXUIServer(
-            s.id, s.url, s.indoub_id, s.login, s.password, s.need_gb
-        )
-        for s in servers
-    ]
-
-    config_lines = []
-    trafic = 0
-    # Итерируемся по серверам (отсортированы по id), а не по user_servers
-    for server in servers:
-        # Ищем user_server для этого сервера
-        user_server = None
-        for us in user_servers:
-            if us.server_id == server.id:
-                user_server = us
-                break
-
-        if not user_server:
-            continue
-
-        # Ищем панель
-        for panel in threex_panels:
-            if panel.id == server.id:
-                vless_url = await panel.get_client_vless(user_server.tun_id)
-                if panel.need_gb:
-                    trafic = await panel.client_remain_trafic(user_server.tun_id) or 0
-                if vless_url:
-                    config_lines.append(vless_url)
-                break
-
-    if not config_lines:
-        raise HTTPException(status_code=404, detail="No configs found")
-
-    response = Response(
-        content="\n".join(config_lines),
-        media_type="text/plain; charset=utf-8"
-    )
+    retry_after = check_rate_limit(request, user_token)
+    version = subscription_version()
+    cached = get_cached_subscription(user_id, if_none_match)
+    if cached:
+        return cached
+    if retry_after:
+        raise too_many_requests(retry_after)
 
-    response.headers['profile-title'] = "base64:" + base64.b64encode('⚡️ SkynetVPN'.encode('utf-8')).decode('latin-1')
-    response.headers["announce"] = "base64:" + base64.b64encode(
-        ("🚀 Нажмите сюда, чтобы перейти в нашего бота\n\n"
-         "👑 - без рекламы на YouTube\n"
-         "🎧 - YouTube можно сворачивать \n\n"
-         "Отображаемое количество трафика относиться только к обходу белых списков.").encode('utf-8')
-    ).decode('latin-1')
-    response.headers["announce-url"] = "https://t.me/skynetaivpn_bot"
-    response.headers["subscription-userinfo"] = (
-        f"expire={int(user.sub_end.timestamp())}; "
-        f"upload={trafic[0]}; download={trafic[1]}; total={trafic[2]}"
-    )
-    response.headers["X-Frame-Options"] = "SAMEORIGIN"
-    response.headers["Referrer-Policy"] = "no-referrer-when-downgrade"
-    response.headers["X-Content-Type-Options"] = "nosniff"
-    response.headers["Permissions-Policy"] = "geolocation=(), microphone=()"
-    response.headers["Strict-Transport-Security"] = "max-age=63072000; includeSubDomains; preload"
-
-    return response
+    prerendered = await get_prerendered_subscription(session, user_id, if_none_match)
+    if prerendered:
+        return prerendered
 
+    user = await orm_get_user(session, user_id)
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
 
+    return await render_subscription(session, user, if_none_match, version)
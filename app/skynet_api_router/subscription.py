@@ -0,0 +1,438 @@
+import os
+import json
+import base64
+import asyncio
+import hashlib
+from datetime import datetime, timedelta
+from urllib.parse import quote
+
+from fastapi import HTTPException, Response
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.database.engine import async_session_maker
+from app.database.models import Server, User
+from app.database.queries import (
+    orm_delete_rendered_subscription,
+    orm_get_inbound_profiles,
+    orm_get_rendered_subscription,
+    orm_get_servers,
+    orm_get_user_servers,
+    orm_get_users_to_prerender,
+    orm_save_inbound_profile,
+    orm_save_rendered_subscription,
+)
+from app.setup_logger import logger
+from app.utils.panel_registry import panel_registry
+from app.utils.subscription_cache import SubscriptionCache, subscription_cache
+from app.utils.three_x_ui_api import PanelUnavailableError, ThreeXUIServer, build_vless_template, render_vless
+
+
+# Сколько секунд ждем одну панель при сборке подписки
+PANEL_TIMEOUT = float(os.getenv("SUBSCRIPTION_PANEL_TIMEOUT", 3))
+# Сколько ждем трафик клиента, когда ссылка собирается по шаблону без панели
+TRAFFIC_TIMEOUT = float(os.getenv("SUBSCRIPTION_TRAFFIC_TIMEOUT", PANEL_TIMEOUT))
+
+# Последние удачные строки подписки по (пользователь, сервер) - отдаются, пока панель недоступна
+last_good_lines = SubscriptionCache(
+    ttl=float(os.getenv("SUBSCRIPTION_STALE_TTL", 7 * 24 * 3600)),
+    max_size=int(os.getenv("SUBSCRIPTION_STALE_SIZE", 100000))
+)
+# Фоновые запросы к медленным панелям, которые продолжают выполняться после таймаута
+_revalidations: set[asyncio.Task] = set()
+
+# Фоновая предсборка подписок: как часто пересобираем готовую подписку и сколько собираем параллельно
+PRERENDER_MAX_AGE = float(os.getenv("SUBSCRIPTION_PRERENDER_MAX_AGE", 600))
+PRERENDER_CONCURRENCY = int(os.getenv("SUBSCRIPTION_PRERENDER_CONCURRENCY", 10))
+# Сколько живет готовая заглушка "подписка закончилась"
+EXPIRED_TTL = float(os.getenv("SUBSCRIPTION_EXPIRED_TTL", 3600))
+
+ANNOUNCE = (
+    "🚀 Нажмите сюда, чтобы перейти в нашего бота\n\n"
+    "👑 - без рекламы на YouTube\n"
+    "🎧 - YouTube можно сворачивать \n\n"
+    "Отображаемое количество трафика относиться только к обходу белых списков."
+)
+EXPIRED_ANNOUNCE = "🚀 Нажмите сюда, тут можно продлить подписку"
+
+
+def _b64_header(text: str) -> str:
+    return "base64:" + base64.b64encode(text.encode('utf-8')).decode('latin-1')
+
+
+def _etag(content: bytes, userinfo: str | None) -> str:
+    """Сильный ETag по строкам конфига и subscription-userinfo"""
+    digest = hashlib.sha256(content)
+    digest.update((userinfo or '').encode('utf-8'))
+    return f'"{digest.hexdigest()[:32]}"'
+
+
+def _etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    return etag in (tag.strip().removeprefix('W/') for tag in if_none_match.split(','))
+
+
+def _not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag})
+
+
+def _subscription_response(content: str, announce: str, userinfo: str | None = None) -> Response:
+    response = Response(
+        content=content,
+        media_type="text/plain; charset=utf-8"
+    )
+
+    response.headers["ETag"] = _etag(response.body, userinfo)
+    response.headers['profile-title'] = _b64_header('⚡️ SkynetVPN')
+    response.headers["announce"] = _b64_header(announce)
+    response.headers["announce-url"] = "https://t.me/skynetaivpn_bot"
+    if userinfo:
+        response.headers["subscription-userinfo"] = userinfo
+    response.headers["X-Frame-Options"] = "SAMEORIGIN"
+    response.headers["Referrer-Policy"] = "no-referrer-when-downgrade"
+    response.headers["X-Content-Type-Options"] = "nosniff"
+    response.headers["Permissions-Policy"] = "geolocation=(), microphone=()"
+    response.headers["Strict-Transport-Security"] = "max-age=63072000; includeSubDomains; preload"
+
+    return response
+
+
+async def refresh_inbound_profile(session: AsyncSession, server: Server) -> bool:
+    """Снимает профиль индауба с панели и сохраняет шаблон ссылки рядом с сервером"""
+    panel = panel_registry.get(server)
+    profile = await panel.get_inbound_profile()
+    if profile is None:
+        return False
+
+    # У клиентов разный flow - ссылки собираются по каждому клиенту через панель
+    link_template = build_vless_template(profile, server.name) if profile['flow'] is not None else ''
+    changed = await orm_save_inbound_profile(
+        session,
+        server_id=server.id,
+        profile=json.dumps(profile, ensure_ascii=False),
+        link_template=link_template
+    )
+    if changed:
+        logger.info(f"Обновлен профиль индауба сервера {server.name}")
+    return True
+
+
+async def refresh_inbound_profiles():
+    """Фоновое обновление профилей индаубов - подхватывает изменения, сделанные в панелях"""
+    async with async_session_maker() as session:
+        servers = await orm_get_servers(session)
+        for server in servers:
+            try:
+                await refresh_inbound_profile(session, server)
+            except Exception:
+                logger.warning(f"Не удалось обновить профиль индауба {server.name}", exc_info=True)
+
+
+async def _fetch_server_config(panel: ThreeXUIServer, tun_id: str) -> tuple:
+    """Ссылка и трафик клиента с панели - для серверов без шаблона ссылки"""
+    if not panel.available:
+        return None, None
+
+    if panel.need_gb:
+        vless_url, trafic = await asyncio.gather(
+            panel.get_client_vless(tun_id),
+            panel.client_traffic(tun_id)
+        )
+        return vless_url, trafic or None
+
+    return await panel.get_client_vless(tun_id), None
+
+
+def _task_result(panel: ThreeXUIServer, task: asyncio.Task, default=(None, None)):
+    if task.cancelled():
+        return default
+
+    error = task.exception()
+    if error is None:
+        return task.result()
+    if isinstance(error, PanelUnavailableError):
+        logger.info(f"Панель {panel.url} пропущена: предохранитель открыт")
+    else:
+        logger.warning(f"Ошибка запроса к панели {panel.url}", exc_info=error)
+    return default
+
+
+def _remember_line(key: str, result: tuple):
+    vless_url, trafic = result
+    if not vless_url:
+        return
+
+    previous = last_good_lines.get(key)
+    if trafic is None and previous is not None:
+        trafic = previous[1]
+    last_good_lines.set(key, (vless_url, trafic))
+
+
+def _finish_revalidation(panel: ThreeXUIServer, key: str, task: asyncio.Task):
+    _revalidations.discard(task)
+    _remember_line(key, _task_result(panel, task))
+
+
+def _finish_traffic(panel: ThreeXUIServer, key: str, vless_url: str, task: asyncio.Task):
+    _revalidations.discard(task)
+    _remember_line(key, (vless_url, _task_result(panel, task, default=None) or None))
+
+
+async def _fetch_from_template(panel: ThreeXUIServer, key: str, tun_id: str, link_template: str) -> tuple:
+    """
+    Ссылка по сохраненному шаблону - всегда, без обращения к панели. Трафик запрашивается отдельно
+    в пределах TRAFFIC_TIMEOUT; если панель не успела - отдаем прошлое значение, а запрос дорабатывает в фоне
+    """
+    vless_url = render_vless(link_template, tun_id)
+    trafic = None
+    if panel.need_gb and panel.available:
+        task = asyncio.create_task(panel.client_traffic(tun_id))
+        done, _ = await asyncio.wait({task}, timeout=TRAFFIC_TIMEOUT)
+        if task in done:
+            trafic = _task_result(panel, task, default=None) or None
+        else:
+            logger.warning(f"Панель {panel.url} не отдала трафик за {TRAFFIC_TIMEOUT} с, обновим в фоне")
+            _revalidations.add(task)
+            task.add_done_callback(lambda t: _finish_traffic(panel, key, vless_url, t))
+
+    _remember_line(key, (vless_url, trafic))
+    stale = last_good_lines.get(key)
+    return vless_url, trafic or (stale[1] if stale is not None else None), True
+
+
+async def _fetch_with_fallback(
+    user: User,
+    panel: ThreeXUIServer,
+    tun_id: str,
+    link_template: str | None
+) -> tuple:
+    """
+    Строка подписки с одной панели в пределах PANEL_TIMEOUT (stale-while-revalidate).
+    Если панель не ответила вовремя или с ошибкой - отдаем последнюю удачную строку,
+    а медленный запрос дорабатывает в фоне и обновляет ее.
+    Возвращает (ссылка, трафик, свежая ли ссылка)
+    """
+    key = f"{user.id}:{panel.id}"
+    if link_template:
+        return await _fetch_from_template(panel, key, tun_id, link_template)
+
+    task = asyncio.create_task(_fetch_server_config(panel, tun_id))
+    done, _ = await asyncio.wait({task}, timeout=PANEL_TIMEOUT)
+
+    if task in done:
+        vless_url, trafic = _task_result(panel, task)
+        _remember_line(key, (vless_url, trafic))
+    else:
+        logger.warning(f"Панель {panel.url} не ответила за {PANEL_TIMEOUT} с, обновим в фоне")
+        _revalidations.add(task)
+        task.add_done_callback(lambda t: _finish_revalidation(panel, key, t))
+        vless_url, trafic = None, None
+
+    stale = last_good_lines.get(key)
+    if stale is not None:
+        return vless_url or stale[0], trafic or stale[1], vless_url is not None
+    return vless_url, trafic, vless_url is not None
+
+
+def _response_from_parts(body: bytes, headers: dict, if_none_match: str | None) -> Response:
+    if _etag_matches(if_none_match, headers["etag"]):
+        return _not_modified(headers["etag"])
+    return Response(content=body, headers=headers)
+
+
+def _expires(user: User) -> datetime:
+    """До какого момента готовая подписка актуальна: рабочие ключи - до окончания подписки, заглушка - EXPIRED_TTL"""
+    now = datetime.now()
+    if user.sub_end and user.sub_end > now:
+        return user.sub_end
+    return now + timedelta(seconds=EXPIRED_TTL)
+
+
+def _cache_parts(user_id, body: bytes, headers: dict, expires: datetime | None):
+    ttl = (expires - datetime.now()).total_seconds() if expires else None
+    subscription_cache.set(user_id, (body, headers), ttl=ttl)
+
+
+def subscription_version() -> int:
+    """Номер последнего сброса подписок. Снимается до чтения пользователя, передается в render_subscription"""
+    return subscription_cache.version
+
+
+def get_cached_subscription(user_id, if_none_match: str | None = None) -> Response | None:
+    """Готовая подписка из кэша - без обращений к БД и панелям"""
+    cached = subscription_cache.get(user_id)
+    if cached is None:
+        return None
+
+    body, headers = cached
+    return _response_from_parts(body, headers, if_none_match)
+
+
+async def get_prerendered_subscription(
+    session: AsyncSession,
+    user_id,
+    if_none_match: str | None = None
+) -> Response | None:
+    """Готовая подписка из таблицы rendered_subscriptions - одно чтение по первичному ключу"""
+    version = subscription_version()
+    rendered = await orm_get_rendered_subscription(session, user_id)
+    if rendered is None or (rendered.expires and rendered.expires <= datetime.now()):
+        return None
+
+    body = rendered.body.encode('utf-8')
+    headers = json.loads(rendered.headers)
+    # Пока читали, подписку могли сбросить - тогда в кэш прочитанное не кладем
+    if not subscription_cache.changed_since(user_id, version):
+        _cache_parts(user_id, body, headers, rendered.expires)
+    return _response_from_parts(body, headers, if_none_match)
+
+
+async def _store_subscription(session: AsyncSession, user: User, response: Response, version: int):
+    """
+    Сохраняет собранную подписку, если за время сборки ее не сбросили (version - номер сброса
+    на момент чтения пользователя). Иначе результат собран по устаревшим данным и отбрасывается
+    """
+    if subscription_cache.changed_since(user.id, version):
+        logger.info(f"Подписка {user.id} сброшена во время сборки, не сохраняем")
+        return
+
+    headers = dict(response.headers)
+    try:
+        await orm_save_rendered_subscription(
+            session,
+            user_id=user.id,
+            body=response.body.decode('utf-8'),
+            headers=json.dumps(headers, ensure_ascii=False),
+            expires=_expires(user)
+        )
+    except Exception:
+        await session.rollback()
+        logger.warning(f"Не удалось сохранить готовую подписку {user.id}", exc_info=True)
+        return
+
+    if subscription_cache.changed_since(user.id, version):
+        # Сброс пришел, пока сохраняли: строка могла записаться после его удаления
+        await orm_delete_rendered_subscription(session, user.id)
+        return
+    _cache_parts(user.id, response.body, headers, _expires(user))
+
+
+async def render_subscription(
+    session: AsyncSession,
+    user: User,
+    if_none_match: str | None = None,
+    version: int | None = None
+) -> Response:
+    """
+    Собирает подписку пользователя. Все панели опрашиваются одновременно.
+    Если подписка не изменилась с прошлого раза (If-None-Match) - отвечает 304.
+    version - subscription_version(), снятый до чтения user из БД
+    """
+    if version is None:
+        version = subscription_version()
+    response, complete = await _render_subscription(session, user)
+    # Неполную подписку (часть панелей не ответила) не сохраняем
+    if complete:
+        await _store_subscription(session, user, response, version)
+
+    if _etag_matches(if_none_match, response.headers["etag"]):
+        return _not_modified(response.headers["etag"])
+    return response
+
+
+async def _prerender_user(semaphore: asyncio.Semaphore, user: User, version: int) -> bool:
+    async with semaphore:
+        async with async_session_maker() as session:
+            try:
+                response, complete = await _render_subscription(session, user)
+            except HTTPException:
+                return False
+            if complete:
+                await _store_subscription(session, user, response, version)
+            return complete
+
+
+async def prerender_subscriptions():
+    """
+    Фоновая предсборка подписок активных пользователей в rendered_subscriptions.
+    Собираются только пользователи без готовой подписки (сброшена при изменении пользователя,
+    тарифа или серверов) или с подпиской старше PRERENDER_MAX_AGE
+    """
+    version = subscription_version()
+    async with async_session_maker() as session:
+        users = await orm_get_users_to_prerender(
+            session,
+            rendered_before=datetime.now() - timedelta(seconds=PRERENDER_MAX_AGE)
+        )
+
+    if not users:
+        return
+
+    semaphore = asyncio.Semaphore(PRERENDER_CONCURRENCY)
+    results = await asyncio.gather(
+        *(_prerender_user(semaphore, user, version) for user in users),
+        return_exceptions=True
+    )
+    rendered = sum(1 for result in results if result is True)
+    logger.info(f"Предсборка подписок: {rendered} из {len(users)}")
+
+
+async def _render_subscription(session: AsyncSession, user: User) -> tuple[Response, bool]:
+    today = datetime.now()
+
+    if not user.sub_end or user.sub_end < today:
+        return _subscription_response(
+            content=(
+                f"vless://{user.id}@1.23.123.4:8452?"
+                f"type=tcp&spx=%2F&flow=#{quote('❌ Ваша подписка закончилась')}"
+            ),
+            announce=EXPIRED_ANNOUNCE
+        ), True
+
+    user_servers = await orm_get_user_servers(session, user.id)
+    if not user_servers:
+        raise HTTPException(status_code=404, detail="No servers for user")
+
+    servers = await orm_get_servers(session)
+    profiles = await orm_get_inbound_profiles(session)
+    tun_ids = {us.server_id: us.tun_id for us in user_servers}
+
+    # Порядок строк - по id серверов
+    panels = [
+        panel for panel in panel_registry.get_panels(servers)
+        if panel.id in tun_ids
+    ]
+    results = await asyncio.gather(*(
+        _fetch_with_fallback(
+            user,
+            panel,
+            tun_ids[panel.id],
+            profiles[panel.id].link_template if panel.id in profiles else None
+        )
+        for panel in panels
+    ))
+
+    config_lines = []
+    trafic = None
+    for panel, (vless_url, server_trafic, _) in zip(panels, results):
+        if server_trafic:
+            trafic = server_trafic
+        if vless_url:
+            config_lines.append(vless_url)
+        else:
+            logger.warning(f"Пользователь не найден на сервере {panel.id}")
+
+    if not config_lines:
+        raise HTTPException(status_code=404, detail="No configs found")
+
+    upload, download, total = trafic or (0, 0, 0)
+    return _subscription_response(
+        content="\n".join(config_lines),
+        announce=ANNOUNCE,
+        userinfo=(
+            f"expire={int(user.sub_end.timestamp())}; "
+            f"upload={upload}; download={download}; total={total}"
+        )
+    ), all(fresh for _, _, fresh in results)
@@ -10,6 +10,8 @@ from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.database.queries import orm_get_user_by_tgid
 from app.setup_logger import logger
+from app.utils.rate_limiter import check_rate_limit, too_many_requests
+from app.utils.sub_tokens import telegram_id_tokens_accepted, sign_user_token, verify_user_token
 from app.tg_bot_router.handlers.admin_private import admin_private_router
 from app.tg_bot_router.handlers.user_private import user_private_router
 from app.tg_bot_router.middlewares.session_middleware import DataBaseSession
@@ -41,14 +43,30 @@ async def webhook(request: Request):
 
 
 @bot_router.get("/v2ray")
-async def redirect_to_v2ray(telegram_id: int, session: AsyncSession = Depends(get_async_session)):
-    user = await orm_get_user_by_tgid(session, telegram_id=telegram_id)
-
-    if user:
-        url = f'v2raytun://import/{os.getenv("URL")}/api/subscribtion?user_token={user.id}'
-        return RedirectResponse(url=url, status_code=status.HTTP_302_FOUND)
+async def redirect_to_v2ray(
+    request: Request,
+    token: str | None = None,
+    telegram_id: int | None = None,
+    session: AsyncSession = Depends(get_async_session)
+):
+    retry_after = check_rate_limit(request, token or telegram_id)
+    if retry_after:
+        raise too_many_requests(retry_after)
+
+    if token is not None:
+        # Подписанный токен проверяется без обращения к БД
+        if verify_user_token(token) is None:
+            raise HTTPException(status_code=404, detail="Item not found")
+    elif telegram_id is not None and telegram_id_tokens_accepted():
+        user = await orm_get_user_by_tgid(session, telegram_id=telegram_id)
+        if not user:
+            raise HTTPException(status_code=404, detail="Item not found")
+        token = sign_user_token(user.id)
     else:
-        return HTTPException(status_code=404, detail="Item not found")
+        raise HTTPException(status_code=404, detail="Item not found")
+
+    url = f'v2raytun://import/{os.getenv("URL")}/api/subscribtion?user_token={token}'
+    return RedirectResponse(url=url, status_code=status.HTTP_302_FOUND)
 
 
 async def start_bot():
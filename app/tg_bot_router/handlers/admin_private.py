@@ -9,6 +9,7 @@ from aiogram.exceptions import TelegramBadRequest
 from aiogram.fsm.state import State, StatesGroup
 from sqlalchemy.ext.asyncio import AsyncSession
 
+from app.database.engine import async_session_maker
 from app.database.models import Tariff
 from app.tg_bot_router.common.link_worker import process_server_url
 from app.tg_bot_router.filters.user_filter import AdminFilter
@@ -18,27 +19,27 @@ from app.utils.days_to_month import days_to_str
 from app.setup_logger import logger
 from app.database.queries import (
     orm_add_faq,
-    orm_add_user_server,
+    orm_add_user_servers,
     orm_delete_faq,
     orm_add_server,
     orm_add_tariff,
     orm_delete_server,
     orm_get_faq,
     orm_get_server,
-    orm_get_server_by_ui,
     orm_get_servers,
     orm_get_tariff,
     orm_get_tariffs,
-    orm_get_user_server_by_ti,
     orm_update_server, 
     orm_update_tariff,
     orm_delete_tariff,
-    orm_get_users,
-    orm_get_subscribers,
+    orm_delete_user_servers_by_ids,
     orm_delete_user_servers_by_si,
-    orm_get_user_servers_by_si
+    orm_get_user_servers_by_si,
+    orm_stream_user_contacts,
+    orm_stream_users_to_provision
 )
-from app.utils.three_x_ui_api import ThreeXUIServer
+from app.utils.panel_registry import panel_registry
+from app.skynet_api_router.subscription import refresh_inbound_profile
 
 
 admin_private_router = Router()
@@ -322,6 +323,16 @@ async def add_server_need_gb(message: types.Message, state: FSMContext):
     )
 
 
+async def _refresh_inbound_profile(session: AsyncSession, server) -> bool:
+    """Профиль индауба нового/измененного сервера; недоступная панель не прерывает добавление"""
+    try:
+        return await refresh_inbound_profile(session, server)
+    except Exception:
+        await session.rollback()
+        logger.warning(f"Не удалось получить профиль индауба {server.url}", exc_info=True)
+        return False
+
+
 @admin_private_router.message(FSMAddServer.need_gb, F.text)
 async def add_server_password(message: types.Message, state: FSMContext, session: AsyncSession):
     if FSMAddServer.server_to_change and message.text == '.':
@@ -338,10 +349,13 @@ async def add_server_password(message: types.Message, state: FSMContext, session
 
     if FSMAddServer.server_to_change:
         await orm_update_server(session, data, FSMAddServer.server_to_change.id)
+        server = await orm_get_server(session, FSMAddServer.server_to_change.id)
+        if not await _refresh_inbound_profile(session, server):
+            await message.answer("⚠️ Не удалось получить настройки индауба, ссылки будут запрашиваться у панели")
         FSMAddServer.server_to_change = None
         await message.answer("✅ Сервер изменен", reply_markup=admin_menu_kbrd())
     else:
-        await orm_add_server(
+        server = await orm_add_server(
             session, 
             name=data['name'],
             url=data['url'],
@@ -350,41 +364,61 @@ async def add_server_password(message: types.Message, state: FSMContext, session
             password=data['password'],
             need_gb=data['need_gb']
         )
-        users = await orm_get_users(session)
-        servers = await orm_get_servers(session)
-        threex_panel = ThreeXUIServer(
-            0,
-            data['url'],
-            data['indoub_id'],
-            data['login'],
-            data['password'],
-            data['need_gb']
-        )
-        server = await orm_get_server_by_ui(session, data['url'], data['indoub_id'])
-
-        for user in users:
-            if user.sub_end:
-                tariff = None
-                if data['need_gb']:
-                    tariff = await orm_get_tariff(session, user.tariff_id)
-                uuid = uuid4()
-                await orm_add_user_server(
-                    session,
-                    user_id=user.id,
-                    server_id=server.id,
-                    tun_id=str(uuid)
-                )
-                user_server = await orm_get_user_server_by_ti(session, str(uuid))
-                await threex_panel.add_client(
-                    uuid=str(uuid),
-                    email=data['name']+'_'+str(user_server.id),
-                    limit_ip=user.ips,
-                    name=user.name,
-                    tg_id=str(user.telegram_id),
-                    expiry_time=int(user.sub_end.timestamp() * 1000),
-                    total_gb=tariff.trafic if tariff and data['need_gb'] else 0
-                )
-        await message.answer("✅ Сервер добавлен", reply_markup=admin_menu_kbrd())
+        threex_panel = panel_registry.get(server)
+        if not await _refresh_inbound_profile(session, server):
+            await message.answer("⚠️ Не удалось получить настройки индауба, ссылки будут запрашиваться у панели")
+
+        added = total = 0
+        stopped = False
+        # Пользователи читаются потоком в отдельной сессии: пока курсор открыт, записи идут через session
+        async with async_session_maker() as read_session:
+            async for users in orm_stream_users_to_provision(read_session):
+                user_servers = await orm_add_user_servers(session, [
+                    {'user_id': user.id, 'server_id': server.id, 'tun_id': str(uuid4())}
+                    for user in users
+                ])
+
+                clients = []
+                for user, user_server in zip(users, user_servers):
+                    clients.append({
+                        'uuid': user_server.tun_id,
+                        'email': data['name']+'_'+str(user_server.id),
+                        'limit_ip': user.ips,
+                        'name': user.name,
+                        'tg_id': str(user.telegram_id),
+                        'expiry_time': int(user.sub_end.timestamp() * 1000),
+                        'total_gb': user.trafic if user.trafic and data['need_gb'] else 0
+                    })
+
+                total += len(clients)
+                try:
+                    results = await threex_panel.add_clients(clients)
+                except Exception:
+                    logger.error(f"Не удалось добавить клиентов на {server.url}", exc_info=True)
+                    # Часть пачки могла успеть добавиться до ошибки - сверяемся с панелью
+                    existing = await threex_panel.existing_clients([client['uuid'] for client in clients])
+                    results = {client['uuid']: client['uuid'] in existing for client in clients}
+                    stopped = True
+
+                added += sum(results.values())
+                # Связи без клиента на панели не оставляем: доступ к серверу выдастся при следующей оплате
+                await orm_delete_user_servers_by_ids(session, [
+                    user_server.id for user_server in user_servers if not results.get(user_server.tun_id)
+                ])
+                if stopped:
+                    break
+
+        if stopped:
+            await message.answer(
+                f"⚠️ Сервер добавлен, но панель перестала отвечать - добавление клиентов остановлено\n"
+                f"Клиентов добавлено: {added} из {total}. Остальные получат доступ к серверу при следующей оплате",
+                reply_markup=admin_menu_kbrd()
+            )
+        else:
+            await message.answer(
+                f"✅ Сервер добавлен\nКлиентов добавлено: {added} из {total}",
+                reply_markup=admin_menu_kbrd()
+            )
 
     await state.clear()
 
@@ -396,13 +430,7 @@ async def delete_server(callback_query: types.CallbackQuery, session: AsyncSessi
         server = await orm_get_server(session, server_id)
         users_servers = await orm_get_user_servers_by_si(session, server_id)
 
-        threex_panel = ThreeXUIServer(
-            id=0, 
-            url=server.url, 
-            indoub_id=server.indoub_id, 
-            login=server.login, 
-            password=server.password
-        )
+        threex_panel = panel_registry.get(server)
         
         if users_servers:
             for i in users_servers:
@@ -569,14 +597,10 @@ async def send_letter(
     text: str = data.get("text")
     pictures: list[str] = data.get("pictures", [])
 
-    if callback.data == "active_subscribers":
-        users = await orm_get_subscribers(session)
-    else:
-        users = await orm_get_users(session)
-
+    users = orm_stream_user_contacts(session, subscribers_only=callback.data == "active_subscribers")
     sent = 0
 
-    for user in users:
+    async for user in users:
         try:
             if pictures:
                 media = [
@@ -615,57 +639,41 @@ async def send_letter(
 @admin_private_router.message(Command('fix_traffic'))
 async def fix_traffic_limits(message: types.Message, session: AsyncSession):
     """Исправить лимиты трафика у всех пользователей"""
-    from app.database.queries import orm_get_users, orm_get_user_servers, orm_get_servers, orm_get_tariff
-    from app.utils.three_x_ui_api import ThreeXUIServer
+    from app.database.queries import orm_stream_user_servers, orm_get_servers
     
     await message.answer("🔄 Исправляю лимиты трафика...")
     
-    users = await orm_get_users(session)
     servers = await orm_get_servers(session)
     
-    # Создаём панели
-    panels = []
-    for s in servers:
-        panels.append(ThreeXUIServer(
-            s.id, s.url, s.indoub_id, s.login, s.password, s.need_gb, s.name
-        ))
+    panels = {panel.id: panel for panel in panel_registry.get_panels(servers)}
     
     fixed = 0
-    for user in users:
-        if not user.tariff_id or user.tariff_id == 0:
-            continue
-            
-        tariff = await orm_get_tariff(session, user.tariff_id)
-        if not tariff:
+    # Записи подписчиков на серверах сразу с нужными полями пользователя и тарифа
+    async for us in orm_stream_user_servers(session, subscribers_only=True):
+        panel = panels.get(us.server_id)
+        if not panel:
             continue
         
-        user_servers = await orm_get_user_servers(session, user.id)
+        # Лимит только для need_gb серверов
+        if panel.need_gb:
+            traffic_limit = 30  * 1073741824
+        else:
+            traffic_limit = 0
         
-        for us in user_servers:
-            for panel in panels:
-                if panel.id != us.server_id:
-                    continue
-                
-                # Лимит только для need_gb серверов
-                if panel.need_gb:
-                    traffic_limit = 30  * 1073741824
-                else:
-                    traffic_limit = 0
-                
-                # Обновляем клиента
-                result = await panel.edit_client(
-                    uuid=us.tun_id,
-                    email=panel.name + '_' + str(us.id),
-                    limit_ip=tariff.ips,
-                    expiry_time=int(user.sub_end.timestamp() * 1000),
-                    tg_id=user.telegram_id,
-                    name=user.name,
-                    total_gb=traffic_limit
-                )
-                
-                if result:
-                    fixed += 1
-                    logger.info(f"Обновлён {user.name} на {panel.name}: {traffic_limit} bytes")
+        # Обновляем клиента
+        result = await panel.edit_client(
+            uuid=us.tun_id,
+            email=panel.name + '_' + str(us.id),
+            limit_ip=us.ips,
+            expiry_time=int(us.sub_end.timestamp() * 1000),
+            tg_id=us.telegram_id,
+            name=us.name,
+            total_gb=traffic_limit
+        )
+        
+        if result:
+            fixed += 1
+            logger.info(f"Обновлён {us.name} на {panel.name}: {traffic_limit} bytes")
     
     await message.answer(
         f"✅ Готово!\n📊 Обновлено клиентов: {fixed}",
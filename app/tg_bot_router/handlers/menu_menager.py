@@ -6,6 +6,7 @@ from aiogram import types
 
 from app.database.queries import orm_get_faq, orm_change_user_tariff, orm_get_servers, orm_get_tariff, orm_get_tariffs, orm_get_user_by_tgid, orm_get_user_servers
 from app.utils.days_to_month import days_to_str
+from app.utils.sub_tokens import subscription_url, v2ray_url
 from app.tg_bot_router.kbds.inline import (
     MenuCallback,
     choose_device_btns,
@@ -105,10 +106,10 @@ async def check_subscribe(
     user_servers = await orm_get_user_servers(session, user.id)
 
     if user.tariff_id > 0:
-        caption = f"⚙️ Ваша подписка SkynetVPN: \n├ Цена: {tariff.price}\n├ Срок: {days_to_str(tariff.days)}\n├ Количество устройств: {user.ips}\n└ оплачено до {user.sub_end.strftime('%d-%m-%Y')}\n\nВаша ссылка на ключ. 🔑 \n\nНажмите 1 раз чтобы скопировать: <code>{os.getenv('URL')}/api/subscribtion?user_token={user.id}</code>"
+        caption = f"⚙️ Ваша подписка SkynetVPN: \n├ Цена: {tariff.price}\n├ Срок: {days_to_str(tariff.days)}\n├ Количество устройств: {user.ips}\n└ оплачено до {user.sub_end.strftime('%d-%m-%Y')}\n\nВаша ссылка на ключ. 🔑 \n\nНажмите 1 раз чтобы скопировать: <code>{subscription_url(user.id)}</code>"
         keyboard = get_inlineMix_btns(
             btns={
-                "↗️ Подключиться v2rayTun": f"{os.getenv('URL')}/bot/v2ray?telegram_id={user.telegram_id}",
+                "↗️ Подключиться v2rayTun": v2ray_url(user.id),
                 "🛍 Продлить подписку": MenuCallback(level=2, menu_name='subscribes').pack(),
                 "❌ Отменить подписку": MenuCallback(level=4, menu_name='cancel').pack(),
                 '🔄 Обновить ключ': MenuCallback(level=4, menu_name='check').pack(),
@@ -117,10 +118,10 @@ async def check_subscribe(
             sizes=(1,)
         )
     elif user_servers:
-        caption = f"⚙️ Ваша подписка SkynetVPN: \n└ оплачено до {user.sub_end.strftime('%d-%m-%Y')}\n\n⚠️ Ваша подписка отменена и больше не будет автоматически продлеваться.\n\nВаша ссылка на ключ. 🔑 \n\nНажмите 1 раз чтобы скопировать: <code>{os.getenv('URL')}/api/subscribtion?user_token={user.id}</code>"
+        caption = f"⚙️ Ваша подписка SkynetVPN: \n└ оплачено до {user.sub_end.strftime('%d-%m-%Y')}\n\n⚠️ Ваша подписка отменена и больше не будет автоматически продлеваться.\n\nВаша ссылка на ключ. 🔑 \n\nНажмите 1 раз чтобы скопировать: <code>{subscription_url(user.id)}</code>"
         keyboard = get_inlineMix_btns(
             btns={
-                "↗️ Подключиться v2rayTun": f"{os.getenv('URL')}/bot/v2ray?telegram_id={user.telegram_id}",
+                "↗️ Подключиться v2rayTun": v2ray_url(user.id),
                 "🛍 Продлить подписку": MenuCallback(level=2, menu_name='subscribes').pack(),
                 '🔄 Обновить ключ': MenuCallback(level=4, menu_name='check').pack(),
                 "⬅️ Назад": MenuCallback(level=1, menu_name='main').pack()
@@ -7,6 +7,7 @@ from aiogram.utils.keyboard import InlineKeyboardBuilder
 
 from app.database.models import Tariff, User
 from app.utils.days_to_month import days_to_str
+from app.utils.sub_tokens import v2ray_url
 
 
 class MenuCallback(CallbackData, prefix="main"):
@@ -88,7 +89,7 @@ def install_btns(url, level):
 def succes_pay_btns(user: User, sizes: tuple = (1,)):
     keyboard = get_inlineMix_btns(
         btns={
-            "↗️ Подключиться v2rayTun": f"{os.getenv('URL')}/bot/v2ray?telegram_id={user.telegram_id}",
+            "↗️ Подключиться v2rayTun": v2ray_url(user.id),
             "📔 Инструкция по установке": MenuCallback(level=5, menu_name='help').pack()
         },
         sizes=sizes
@@ -0,0 +1,84 @@
+import time
+
+from app.setup_logger import logger
+
+
+class CircuitBreaker:
+    """
+    Предохранитель для внешнего сервиса.
+    closed - запросы идут; после failure_threshold ошибок подряд - open, запросы сразу отклоняются;
+    через reset_timeout секунд - half-open, пропускается half_open_probes пробных запросов:
+    успех закрывает предохранитель, ошибка снова открывает
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30,
+        half_open_probes: int = 1
+    ) -> None:
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_probes = half_open_probes
+
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probes = 0
+
+
+    @property
+    def is_open(self) -> bool:
+        """Открыт и время пробного запроса еще не пришло"""
+        return self.state == self.OPEN and time.monotonic() - self.opened_at < self.reset_timeout
+
+
+    def allow(self) -> bool:
+        if self.state == self.CLOSED:
+            return True
+
+        if self.state == self.OPEN:
+            if self.is_open:
+                return False
+            self.state = self.HALF_OPEN
+            self._probes = 0
+
+        if self._probes < self.half_open_probes:
+            self._probes += 1
+            return True
+        return False
+
+
+    def release(self):
+        """Запрос отменен до ответа: пробный слот half-open освобождается без вывода о здоровье сервиса"""
+        if self.state == self.HALF_OPEN and self._probes > 0:
+            self._probes -= 1
+
+
+    def record_success(self):
+        if self.state != self.CLOSED:
+            logger.info(f"{self.name}: связь восстановлена")
+        self.state = self.CLOSED
+        self.failures = 0
+
+
+    def record_failure(self):
+        if self.state == self.HALF_OPEN:
+            self._open()
+            return
+
+        self.failures += 1
+        if self.state == self.CLOSED and self.failures >= self.failure_threshold:
+            self._open()
+
+
+    def _open(self):
+        logger.warning(f"{self.name}: недоступен, запросы приостановлены на {self.reset_timeout} с")
+        self.state = self.OPEN
+        self.opened_at = time.monotonic()
+        self.failures = 0
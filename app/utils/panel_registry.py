@@ -0,0 +1,81 @@
+import asyncio
+
+from app.database.models import Server
+from app.setup_logger import logger
+from app.utils.three_x_ui_api import ThreeXUIServer, close_panel_client
+
+
+class PanelRegistry:
+    """
+    Реестр панелей 3x-ui на весь процесс (ключ - Server.id).
+    Панель хранит авторизованную сессию между запросами и пересоздается
+    только при изменении строки сервера.
+    """
+    def __init__(self) -> None:
+        self._panels: dict[int, ThreeXUIServer] = {}
+        self._fingerprints: dict[int, tuple] = {}
+        self._closing: set[asyncio.Task] = set()
+
+
+    @staticmethod
+    def _fingerprint(server: Server) -> tuple:
+        return (
+            server.name,
+            server.url,
+            server.indoub_id,
+            server.login,
+            server.password,
+            server.need_gb,
+        )
+
+
+    def get(self, server: Server) -> ThreeXUIServer:
+        fingerprint = self._fingerprint(server)
+        panel = self._panels.get(server.id)
+
+        if panel is None or self._fingerprints.get(server.id) != fingerprint:
+            old_panel = panel
+            panel = ThreeXUIServer(
+                server.id,
+                server.url,
+                server.indoub_id,
+                server.login,
+                server.password,
+                server.need_gb,
+                server.name
+            )
+            self._panels[server.id] = panel
+            self._fingerprints[server.id] = fingerprint
+            if old_panel is not None:
+                self._retire(old_panel)
+
+        return panel
+
+
+    def get_panels(self, servers) -> list[ThreeXUIServer]:
+        return [self.get(server) for server in servers]
+
+
+    def invalidate(self, server_id: int):
+        panel = self._panels.pop(server_id, None)
+        self._fingerprints.pop(server_id, None)
+        if panel is not None:
+            self._retire(panel)
+
+
+    def _retire(self, panel: ThreeXUIServer):
+        """Закрывает http-клиент замененной панели, если его не использует другая панель реестра"""
+        key = (panel.url, panel.login)
+        if any((other.url, other.login) == key for other in self._panels.values()):
+            return
+
+        try:
+            task = asyncio.get_running_loop().create_task(close_panel_client(*key))
+        except RuntimeError:
+            logger.warning(f"Клиент панели {panel.url} не закрыт: нет запущенного цикла событий")
+            return
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+
+panel_registry = PanelRegistry()
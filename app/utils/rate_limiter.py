@@ -0,0 +1,76 @@
+import math
+import os
+import time
+from collections import OrderedDict
+
+from fastapi import HTTPException, Request, status
+
+
+RATE_LIMIT_TOKEN_BURST = float(os.getenv("RATE_LIMIT_TOKEN_BURST", 10))
+RATE_LIMIT_TOKEN_REFILL = float(os.getenv("RATE_LIMIT_TOKEN_REFILL", 0.2))
+RATE_LIMIT_IP_BURST = float(os.getenv("RATE_LIMIT_IP_BURST", 60))
+RATE_LIMIT_IP_REFILL = float(os.getenv("RATE_LIMIT_IP_REFILL", 1))
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", 50000))
+
+
+class TokenBucketLimiter:
+    """
+    Token bucket в памяти процесса: у каждого ключа до burst токенов,
+    пополнение refill_rate токенов в секунду. Давно не использованные ключи вытесняются (LRU).
+    """
+    def __init__(self, burst: float, refill_rate: float, max_keys: int = RATE_LIMIT_MAX_KEYS) -> None:
+        self.burst = burst
+        self.refill_rate = refill_rate
+        self.max_keys = max_keys
+        self._buckets: OrderedDict[str, tuple[float, float]] = OrderedDict()
+
+
+    @property
+    def enabled(self) -> bool:
+        return self.burst > 0 and self.refill_rate > 0
+
+
+    def hit(self, key) -> float:
+        """Списывает токен. 0 - запрос разрешен, иначе - через сколько секунд появится токен"""
+        if not self.enabled:
+            return 0
+
+        key = str(key)
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.refill_rate)
+
+        if tokens >= 1:
+            tokens -= 1
+            retry_after = 0
+        else:
+            retry_after = (1 - tokens) / self.refill_rate
+
+        self._buckets[key] = (tokens, now)
+        self._buckets.move_to_end(key)
+        while len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+
+        return retry_after
+
+
+    def reset(self, key):
+        self._buckets.pop(str(key), None)
+
+
+token_limiter = TokenBucketLimiter(RATE_LIMIT_TOKEN_BURST, RATE_LIMIT_TOKEN_REFILL)
+ip_limiter = TokenBucketLimiter(RATE_LIMIT_IP_BURST, RATE_LIMIT_IP_REFILL)
+
+
+def check_rate_limit(request: Request, user_token) -> float:
+    """Лимит по токену пользователя и по IP клиента. 0 - запрос разрешен, иначе - Retry-After в секундах"""
+    client_ip = request.client.host if request.client else 'unknown'
+    return max(ip_limiter.hit(client_ip), token_limiter.hit(user_token))
+
+
+def too_many_requests(retry_after: float) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        detail="Too many requests",
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))}
+    )
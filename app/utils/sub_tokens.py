@@ -0,0 +1,84 @@
+import os
+import hmac
+import base64
+import hashlib
+from datetime import datetime
+from uuid import UUID
+
+from app.setup_logger import logger
+
+
+# Секрет подписи. Без секрета токен мог бы подделать кто угодно
+SUB_TOKEN_SECRET = os.getenv("SUB_TOKEN_SECRET")
+if not SUB_TOKEN_SECRET:
+    SUB_TOKEN_SECRET = os.getenv("BOT_TOKEN")
+    if not SUB_TOKEN_SECRET:
+        raise RuntimeError("SUB_TOKEN_SECRET is not set")
+    logger.warning(
+        "SUB_TOKEN_SECRET не задан, ссылки на подписку подписываются токеном бота: "
+        "смена BOT_TOKEN отзовет все выданные ссылки"
+    )
+SUB_TOKEN_SECRET = SUB_TOKEN_SECRET.encode('utf-8')
+# Увеличение версии отзывает все выданные ранее токены
+SUB_TOKEN_VERSION = int(os.getenv("SUB_TOKEN_VERSION", 1))
+# Старые ссылки с id пользователя (случайный uuid4, подобрать нельзя) уже импортированы в приложения
+# пользователей - по умолчанию принимаются
+SUB_TOKEN_ACCEPT_UUID = os.getenv("SUB_TOKEN_ACCEPT_UUID", "1").lower() in ("1", "true", "yes")
+# До какой даты (YYYY-MM-DD) принимаются старые ссылки с telegram_id - его легко узнать,
+# поэтому без даты такие ссылки не принимаются
+_telegram_id_until = os.getenv("SUB_TOKEN_TELEGRAM_ID_UNTIL")
+SUB_TOKEN_TELEGRAM_ID_UNTIL = datetime.fromisoformat(_telegram_id_until) if _telegram_id_until else None
+
+_MAC_SIZE = 12
+
+
+def telegram_id_tokens_accepted() -> bool:
+    return SUB_TOKEN_TELEGRAM_ID_UNTIL is not None and datetime.now() < SUB_TOKEN_TELEGRAM_ID_UNTIL
+
+
+def _mac(payload: bytes) -> bytes:
+    return hmac.new(SUB_TOKEN_SECRET, payload, hashlib.sha256).digest()[:_MAC_SIZE]
+
+
+def sign_user_token(user_id: UUID) -> str:
+    """Компактный токен: версия + id пользователя + HMAC, в base64url без паддинга"""
+    payload = SUB_TOKEN_VERSION.to_bytes(2, 'big') + user_id.bytes
+    return base64.urlsafe_b64encode(payload + _mac(payload)).rstrip(b'=').decode('ascii')
+
+
+def verify_user_token(token: str) -> UUID | None:
+    """id пользователя из токена или None, если токен поддельный или отозван"""
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+    except (ValueError, TypeError):
+        return None
+
+    if len(raw) != 2 + 16 + _MAC_SIZE:
+        return None
+
+    payload, mac = raw[:-_MAC_SIZE], raw[-_MAC_SIZE:]
+    if int.from_bytes(payload[:2], 'big') != SUB_TOKEN_VERSION:
+        return None
+    if not hmac.compare_digest(mac, _mac(payload)):
+        return None
+    return UUID(bytes=payload[2:])
+
+
+def resolve_user_id(user_token: str) -> UUID | None:
+    """Подписанный токен или, если разрешено, старый токен с id пользователя - id пользователя"""
+    user_id = verify_user_token(user_token)
+    if user_id is not None or not SUB_TOKEN_ACCEPT_UUID:
+        return user_id
+
+    try:
+        return UUID(user_token)
+    except ValueError:
+        return None
+
+
+def subscription_url(user_id: UUID) -> str:
+    return f"{os.getenv('URL')}/api/subscribtion?user_token={sign_user_token(user_id)}"
+
+
+def v2ray_url(user_id: UUID) -> str:
+    return f"{os.getenv('URL')}/bot/v2ray?token={sign_user_token(user_id)}"
@@ -0,0 +1,76 @@
+import os
+import time
+from collections import OrderedDict
+from typing import Any
+
+
+SUBSCRIPTION_CACHE_TTL = float(os.getenv("SUBSCRIPTION_CACHE_TTL", 300))
+SUBSCRIPTION_CACHE_SIZE = int(os.getenv("SUBSCRIPTION_CACHE_SIZE", 10000))
+
+
+class SubscriptionCache:
+    """
+    LRU-кэш готовых подписок в памяти процесса (ключ - id пользователя).
+    Запись живет не дольше ttl и сбрасывается явно при изменении пользователя или серверов.
+    Каждый сброс получает номер version: сборка запоминает его до чтения данных и по changed_since
+    узнает, что за время сборки подписку сбросили и результат сохранять нельзя
+    """
+    def __init__(self, ttl: float, max_size: int) -> None:
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        self.version = 0
+        self._invalidated: dict[str, int] = {}
+        self._cleared = 0
+
+
+    def get(self, key) -> Any | None:
+        key = str(key)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        expires, value = entry
+        if expires < time.monotonic():
+            del self._entries[key]
+            return None
+
+        self._entries.move_to_end(key)
+        return value
+
+
+    def set(self, key, value: Any, ttl: float | None = None):
+        if self.max_size <= 0:
+            return
+
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0:
+            return
+
+        key = str(key)
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+
+    def invalidate(self, key):
+        key = str(key)
+        self.version += 1
+        self._invalidated[key] = self.version
+        self._entries.pop(key, None)
+
+
+    def clear(self):
+        self.version += 1
+        self._cleared = self.version
+        self._invalidated.clear()
+        self._entries.clear()
+
+
+    def changed_since(self, key, version: int) -> bool:
+        """Сбрасывалась ли запись key после сброса номер version"""
+        return max(self._cleared, self._invalidated.get(str(key), 0)) > version
+
+
+subscription_cache = SubscriptionCache(SUBSCRIPTION_CACHE_TTL, SUBSCRIPTION_CACHE_SIZE)
@@ -1,9 +1,136 @@
+import os
 import json
+import time
+import random
+import asyncio
+from importlib.util import find_spec
 from urllib.parse import quote
 
-from httpx import AsyncClient
+from httpx import AsyncClient, Limits, Response, Timeout, TransportError
 
 from app.setup_logger import logger
+from app.utils.circuit_breaker import CircuitBreaker
+
+
+PANEL_MAX_CONNECTIONS = int(os.getenv("THREEXUI_MAX_CONNECTIONS", 20))
+PANEL_MAX_KEEPALIVE = int(os.getenv("THREEXUI_MAX_KEEPALIVE", 10))
+PANEL_KEEPALIVE_EXPIRY = float(os.getenv("THREEXUI_KEEPALIVE_EXPIRY", 60))
+PANEL_HTTP2 = os.getenv("THREEXUI_HTTP2", "0") == "1"
+PANEL_CONNECT_TIMEOUT = float(os.getenv("THREEXUI_CONNECT_TIMEOUT", 3))
+PANEL_READ_TIMEOUT = float(os.getenv("THREEXUI_READ_TIMEOUT", 10))
+# Сколько запросов к одной панели может выполняться одновременно
+PANEL_MAX_INFLIGHT = int(os.getenv("THREEXUI_MAX_INFLIGHT", 10))
+# Предохранитель: после скольких ошибок подряд панель считается недоступной и на сколько секунд
+PANEL_BREAKER_FAILURES = int(os.getenv("THREEXUI_BREAKER_FAILURES", 5))
+PANEL_BREAKER_RESET = float(os.getenv("THREEXUI_BREAKER_RESET", 30))
+# Повторы запросов: число попыток, задержки и общий бюджет времени на одну операцию
+PANEL_RETRY_ATTEMPTS = int(os.getenv("THREEXUI_RETRY_ATTEMPTS", 3))
+PANEL_RETRY_BASE_DELAY = float(os.getenv("THREEXUI_RETRY_BASE_DELAY", 0.2))
+PANEL_RETRY_MAX_DELAY = float(os.getenv("THREEXUI_RETRY_MAX_DELAY", 2))
+PANEL_OPERATION_DEADLINE = float(os.getenv("THREEXUI_OPERATION_DEADLINE", 15))
+# Сколько секунд считаем снимок индауба (клиенты, настройки) актуальным
+INBOUND_CACHE_TTL = float(os.getenv("THREEXUI_INBOUND_TTL", 30))
+# Как часто обновляем общий снимок трафика клиентов
+TRAFFIC_CACHE_TTL = float(os.getenv("THREEXUI_TRAFFIC_TTL", 60))
+# Сколько клиентов отправляем в одном запросе addClient
+ADD_CLIENTS_CHUNK = int(os.getenv("THREEXUI_ADD_CLIENTS_CHUNK", 200))
+
+# Один долгоживущий клиент на учетную запись панели (ключ - url и логин):
+# у разных учетных записей одной панели свои cookie
+_panel_clients: dict[tuple[str, str], AsyncClient] = {}
+
+
+def get_panel_client(url: str, login: str) -> AsyncClient:
+    """Возвращает общий keep-alive клиент для панели, создавая его при первом обращении"""
+    client = _panel_clients.get((url, login))
+    if client is None or client.is_closed:
+        http2 = PANEL_HTTP2
+        if http2 and find_spec("h2") is None:
+            logger.warning("THREEXUI_HTTP2 включен, но пакет h2 не установлен - используется HTTP/1.1")
+            http2 = False
+
+        client = AsyncClient(
+            http2=http2,
+            timeout=Timeout(PANEL_READ_TIMEOUT, connect=PANEL_CONNECT_TIMEOUT),
+            limits=Limits(
+                max_connections=PANEL_MAX_CONNECTIONS,
+                max_keepalive_connections=PANEL_MAX_KEEPALIVE,
+                keepalive_expiry=PANEL_KEEPALIVE_EXPIRY,
+            ),
+        )
+        _panel_clients[(url, login)] = client
+    return client
+
+
+async def close_panel_client(url: str, login: str):
+    """Закрывает клиент панели, который больше не нужен (сервер удален или изменен)"""
+    client = _panel_clients.pop((url, login), None)
+    if client is not None:
+        await client.aclose()
+
+
+async def close_panel_clients():
+    """Закрывает все клиенты панелей. Вызывается при остановке приложения"""
+    for client in _panel_clients.values():
+        await client.aclose()
+    _panel_clients.clear()
+
+
+VLESS_UUID_PLACEHOLDER = '{uuid}'
+
+
+def build_vless_link(uuid: str, profile: dict, remark: str) -> str:
+    """vless:// ссылка клиента по профилю индауба. Название берется из email до '_' (имя сервера)"""
+    return (
+        f"vless://{uuid}@{profile['host']}:{profile['port']}?"
+        f"type={profile['network']}&"
+        f"security={profile['security']}&"
+        f"encryption={profile['encryption']}&"
+        f"path={profile['path']}&"
+        f"pbk={profile['pbk']}&"
+        f"fp={profile['fp']}&"
+        f"sni={profile['sni']}&"
+        f"sid={profile['sid']}&"
+        f"spx=%2F&flow={profile['flow']}#{quote(remark.split('_')[0])}"
+    )
+
+
+def build_vless_template(profile: dict, remark: str) -> str:
+    """Шаблон ссылки для всех клиентов индауба, uuid подставляется через render_vless"""
+    return build_vless_link(VLESS_UUID_PLACEHOLDER, profile, remark)
+
+
+def render_vless(template: str, uuid: str) -> str:
+    return template.replace(VLESS_UUID_PLACEHOLDER, uuid, 1)
+
+
+class RetryPolicy:
+    """Повторы с экспоненциальной задержкой и полным джиттером в пределах общего дедлайна операции"""
+    def __init__(
+        self,
+        attempts: int = PANEL_RETRY_ATTEMPTS,
+        base_delay: float = PANEL_RETRY_BASE_DELAY,
+        max_delay: float = PANEL_RETRY_MAX_DELAY,
+        deadline: float = PANEL_OPERATION_DEADLINE
+    ) -> None:
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+# Чтение и идемпотентные операции (updateClient, resetClientTraffic) повторяем,
+# addClient - только после проверки, что клиент не успел добавиться
+NO_RETRY = RetryPolicy(attempts=1)
+RETRY = RetryPolicy()
+
+
+class PanelUnavailableError(Exception):
+    """Панель отключена предохранителем после серии ошибок"""
 
 
 class ThreeXUIServer:
@@ -17,6 +144,62 @@ class ThreeXUIServer:
         self.cookies = None
         self.name = name
 
+        # Номер попытки авторизации и блокировка, чтобы параллельные запросы
+        # логинились в панель один раз, а не каждый сам по себе
+        self._auth_generation = 0
+        self._auth_lock = asyncio.Lock()
+
+        # Снимок индауба, индекс его клиентов по id и трафик клиентов по email/uuid
+        self._inbound = None
+        self._clients = {}
+        self._traffic = {}
+        self._inbound_fetched_at = 0.0
+        self._inbound_lock = asyncio.Lock()
+
+        self._semaphore = asyncio.Semaphore(PANEL_MAX_INFLIGHT)
+        self.breaker = CircuitBreaker(
+            f"Панель {url}",
+            failure_threshold=PANEL_BREAKER_FAILURES,
+            reset_timeout=PANEL_BREAKER_RESET
+        )
+
+
+    @property
+    def client(self) -> AsyncClient:
+        return get_panel_client(self.url, self.login)
+
+
+    @property
+    def available(self) -> bool:
+        """False, пока предохранитель панели открыт - такие панели лучше сразу пропускать"""
+        return not self.breaker.is_open
+
+
+    async def _send(self, method: str, url: str, **kwargs) -> Response:
+        """Низкоуровневый запрос: ограничение параллельности и учет ошибок в предохранителе"""
+        if self.breaker.is_open:
+            raise PanelUnavailableError(f"Панель {self.url} временно недоступна")
+
+        async with self._semaphore:
+            if not self.breaker.allow():
+                raise PanelUnavailableError(f"Панель {self.url} временно недоступна")
+            try:
+                response = await self.client.request(method, url, **kwargs)
+            except asyncio.CancelledError:
+                self.breaker.release()
+                raise
+            except Exception:
+                # Сетевые ошибки и таймауты. Отмена задачи (CancelledError: клиент отключился,
+                # истек дедлайн вызывающего) ничего не говорит о здоровье панели и не учитывается
+                self.breaker.record_failure()
+                raise
+
+        if response.status_code >= 500:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        return response
+
 
     def strin_to_dict(self, string):
         return json.loads(string)
@@ -32,19 +215,187 @@ class ThreeXUIServer:
             'password': self.password,
             'twoFactorCode': ''
         }
-        async with AsyncClient() as client:
-            response = await client.post(url=self.url+'login', json=data)
-            if response.status_code == 200:
-                data = response.json()
-                if data['success']:
-                    pass
-                else:
-                    logger.warning(f"Не удалось авторизоваться: {self.url} - {data['msg']}")
-
+        response = await self._send('POST', self.url+'login', json=data)
+        if response.status_code == 200:
+            data = response.json()
+            if data['success']:
+                pass
             else:
-                logger.warning(f"Не удалось авторизоваться: {self.url} - {response.status_code}")
+                logger.warning(f"Не удалось авторизоваться: {self.url} - {data['msg']}")
+
+        else:
+            logger.warning(f"Не удалось авторизоваться: {self.url} - {response.status_code}")
+
+        self.cookies = response.cookies
+        self._auth_generation += 1
+
+
+    async def _relogin(self, generation: int):
+        """Авторизация single-flight: если пока ждали блокировку кто-то уже залогинился - повторно не логинимся"""
+        async with self._auth_lock:
+            if self._auth_generation == generation:
+                await self.auth()
+
+
+    @staticmethod
+    def _parse_response(response: Response) -> dict | None:
+        if response.status_code != 200:
+            return None
+        try:
+            data = response.json()
+        except ValueError:
+            return None
+        return data if isinstance(data, dict) else None
+
+
+    @staticmethod
+    def _is_auth_failure(response: Response, data: dict | None) -> bool:
+        """
+        Признаки протухшей сессии: редирект на логин, 401, 404 без json или html вместо json.
+        Без сессии 3x-ui отвечает на /panel/api/* пустым 404 (checkAPIAuth) и запрос не выполняет,
+        поэтому после перелогина его можно повторить, даже addClient.
+        success: false - ответ панели по существу (дубликат email, клиент не найден), его отдаем как есть
+        """
+        if response.status_code == 401:
+            return True
+        if response.status_code == 404:
+            try:
+                response.json()
+            except ValueError:
+                return True
+            return False
+        if response.is_redirect:
+            return 'login' in response.headers.get('location', '') or response.headers.get('location') == '/'
+        return response.status_code == 200 and data is None
+
+
+    async def _request_once(self, method: str, path: str, **kwargs) -> tuple[Response, dict | None]:
+        """
+        Запрос к API панели. При признаках истекшей сессии перелогинивается
+        и повторяет запрос один раз. Возвращает ответ и json (None, если ответ не json или не 200)
+        """
+        if not self.cookies:
+            await self._relogin(self._auth_generation)
+
+        for attempt in range(2):
+            generation = self._auth_generation
+            response = await self._send(method, self.url + path, cookies=self.cookies, **kwargs)
+            data = self._parse_response(response)
+
+            if attempt == 0 and self._is_auth_failure(response, data):
+                logger.info(f"Сессия панели {self.url} недействительна, повторная авторизация")
+                await self._relogin(generation)
+                continue
+
+            return response, data
+
+
+    async def _request(
+        self,
+        method: str,
+        path: str,
+        retry: RetryPolicy = NO_RETRY,
+        already_applied=None,
+        deadline: float | None = None,
+        **kwargs
+    ) -> tuple[Response | None, dict | None]:
+        """
+        Запрос с повторами по политике retry: повторяются сетевые ошибки, таймауты и 5xx,
+        пока не кончатся попытки или дедлайн операции.
+        deadline - дедлайн внешней операции (time.monotonic()), если запрос - ее часть.
+        already_applied(deadline) - async-проверка для неидемпотентных операций перед повтором:
+        если вернула True, запрос уже выполнен панелью и повторять его нельзя.
+        Проверка укладывается в оставшееся время операции
+        """
+        own_deadline = time.monotonic() + retry.deadline
+        deadline = own_deadline if deadline is None else min(deadline, own_deadline)
+        attempt = 0
+        while True:
+            attempt += 1
+            response, data, error = None, None, None
+            try:
+                response, data = await asyncio.wait_for(
+                    self._request_once(method, path, **kwargs),
+                    timeout=max(deadline - time.monotonic(), 0)
+                )
+            except (TransportError, TimeoutError) as e:
+                error = e
+
+            if error is None and response.status_code < 500:
+                return response, data
+
+            delay = retry.backoff(attempt)
+            if attempt >= retry.attempts or time.monotonic() + delay >= deadline:
+                if error is not None:
+                    raise error
+                return response, data
+
+            reason = repr(error) if error is not None else response.status_code
+            logger.info(f"Повтор запроса {path} к {self.url} через {delay:.2f} с: {reason}")
+            await asyncio.sleep(delay)
+
+            if already_applied is None:
+                continue
+            try:
+                applied = await asyncio.wait_for(
+                    already_applied(deadline),
+                    timeout=max(deadline - time.monotonic(), 0)
+                )
+            except (TransportError, TimeoutError, PanelUnavailableError) as e:
+                # Не знаем, выполнен ли запрос, а повторять вслепую нельзя
+                logger.warning(f"Не удалось проверить, выполнен ли запрос {path} к {self.url}: {e!r}")
+                if error is not None:
+                    raise error
+                return response, data
+            if applied:
+                logger.info(f"Запрос {path} к {self.url} уже выполнен панелью, повтор не нужен")
+                return response, {'success': True, 'msg': ''}
+
+
+    async def _clients_exist(self, uuids: list[str], deadline: float | None = None) -> bool:
+        inbound = await self.get_inbound(max_age=0, deadline=deadline)
+        return inbound is not None and all(uuid in self._clients for uuid in uuids)
+
+
+    async def existing_clients(self, uuids: list[str]) -> set[str]:
+        """Какие из клиентов есть на панели сейчас (свежий снимок индауба). Пустое множество, если панель не ответила"""
+        try:
+            inbound = await self.get_inbound(max_age=0)
+        except Exception as e:
+            logger.warning(f"Не удалось проверить клиентов на {self.url}: {e!r}")
+            return set()
+        if inbound is None:
+            return set()
+        return {uuid for uuid in uuids if uuid in self._clients}
+
+
+    def _new_client(
+        self,
+        uuid: str,
+        email: str,
+        limit_ip: int,
+        expiry_time: int,
+        tg_id: str,
+        name: str,
+        total_gb: int = 0
+    ) -> dict:
+        if self.need_gb:
+            traffic_limit = (total_gb if total_gb else 30) * 1073741824
+        else:
+            traffic_limit = 0
 
-            self.cookies = response.cookies
+        return {
+            "id": uuid,
+            "alterId": 0,
+            "email": email,
+            "limitIp": limit_ip,
+            "expiryTime": expiry_time,
+            "enable": True,
+            "comment": name,
+            "tgId": str(tg_id),
+            "subId": uuid.split('-')[-1],
+            "totalGB": traffic_limit
+        }
 
 
     async def add_client(
@@ -57,45 +408,75 @@ class ThreeXUIServer:
         name: str,
         total_gb: int = 0
     ):
-        if not self.cookies:
-            await self.auth()
-
-        if self.need_gb:
-            traffic_limit = (total_gb if total_gb else 30) * 1073741824
-        else:
-            traffic_limit = 0
-
         data = {
             "id": self.indoub_id,
             "settings": self.dict_to_sting({
-                "clients": [{
-                    "id": uuid,
-                    "alterId": 0,
-                    "email": email,
-                    "limitIp": limit_ip,
-                    "expiryTime": expiry_time,
-                    "enable": True,
-                    "comment": name,
-                    "tgId": str(tg_id),
-                    "subId": uuid.split('-')[-1],
-                    "totalGB": traffic_limit
-                }]
+                "clients": [self._new_client(uuid, email, limit_ip, expiry_time, tg_id, name, total_gb)]
             })
         }
 
-        async with AsyncClient() as client:
-            response = await client.post(url=self.url+"panel/api/inbounds/addClient", json=data, cookies=self.cookies)
-            if response.status_code == 200:
-                data = response.json()
-                if data['success']:
-                    logger.info(f"Добавлен клиент {name}")
-                    return True
-                else:
-                    logger.warning(f"Не удалось добавить клиента {name}: {data['msg']}")
-                    return False
+        response, data = await self._request(
+            'POST',
+            "panel/api/inbounds/addClient",
+            retry=RETRY,
+            already_applied=lambda deadline: self._clients_exist([uuid], deadline),
+            json=data
+        )
+        if data is not None:
+            if data['success']:
+                logger.info(f"Добавлен клиент {name}")
+                self.invalidate_inbound()
+                return True
             else:
-                logger.warning(f"Не удалось добавить клиента {name}: {self.url} - {response.status_code}")
+                logger.warning(f"Не удалось добавить клиента {name}: {data['msg']}")
                 return False
+        else:
+            logger.warning(f"Не удалось добавить клиента {name}: {self.url} - {response.status_code}")
+            return False
+
+
+    async def add_clients(self, clients: list[dict], chunk_size: int = ADD_CLIENTS_CHUNK) -> dict[str, bool]:
+        """
+        Добавляет клиентов пачками по chunk_size за один запрос addClient.
+        clients - словари с аргументами add_client. Возвращает {uuid: добавлен ли клиент}
+        """
+        results = {}
+        for start in range(0, len(clients), chunk_size):
+            chunk = clients[start:start + chunk_size]
+            data = {
+                "id": self.indoub_id,
+                "settings": self.dict_to_sting({
+                    "clients": [self._new_client(**client) for client in chunk]
+                })
+            }
+
+            response, data = await self._request(
+                'POST',
+                "panel/api/inbounds/addClient",
+                retry=RETRY,
+                already_applied=lambda deadline: self._clients_exist([client['uuid'] for client in chunk], deadline),
+                json=data
+            )
+            if data is not None and data['success']:
+                logger.info(f"Добавлено клиентов: {len(chunk)} на {self.url}")
+                results.update({client['uuid']: True for client in chunk})
+                continue
+
+            reason = data['msg'] if data is not None else response.status_code
+            logger.warning(f"Пачка из {len(chunk)} клиентов не добавлена на {self.url}: {reason}")
+            # Панель отклоняет пачку целиком - добавляем по одному, чтобы узнать результат каждого.
+            # Уже существующих клиентов (например, после оборванного запроса) повторно не добавляем
+            await self.get_inbound(max_age=0)
+            for client in chunk:
+                if client['uuid'] in self._clients:
+                    results[client['uuid']] = True
+                elif len(chunk) == 1:
+                    results[client['uuid']] = False
+                else:
+                    results[client['uuid']] = await self.add_client(**client)
+
+        self.invalidate_inbound()
+        return results
 
 
     async def edit_client(
@@ -108,9 +489,6 @@ class ThreeXUIServer:
         tg_id: str,
         total_gb: int = 0
     ):
-        if not self.cookies:
-            await self.auth()
-
         data = {
             "id": self.indoub_id,
             "settings": self.dict_to_sting({
@@ -129,124 +507,194 @@ class ThreeXUIServer:
             })
         }
 
-        async with AsyncClient() as client:
-            response = await client.post(url=self.url+f"panel/api/inbounds/updateClient/{uuid}", json=data, cookies=self.cookies)
-            if response.status_code == 200:
-                data= response.json()
-                if data['success']:
-                    logger.info(f"Изменен клиент {email}")
-                    return True
-                else:
-                    logger.warning(f"Не удалось изменить клиента {email}: {data['msg']}")
-                    return False
+        response, data = await self._request('POST', f"panel/api/inbounds/updateClient/{uuid}", retry=RETRY, json=data)
+        if data is not None:
+            if data['success']:
+                logger.info(f"Изменен клиент {email}")
+                self.invalidate_inbound()
+                return True
             else:
-                logger.warning(f"Не удалось изменить клиента {email}: {response.status_code}")
+                logger.warning(f"Не удалось изменить клиента {email}: {data['msg']}")
                 return False
+        else:
+            logger.warning(f"Не удалось изменить клиента {email}: {response.status_code}")
+            return False
 
     
     async def client_remain_trafic(self, uuid):
-        if not self.cookies:
-            await self.auth()
-
-        async with AsyncClient() as client:
-            response = await client.get(url=f"{self.url}panel/api/inbounds/getClientTrafficsById/{uuid}", cookies=self.cookies)
-            if response.status_code == 200:
-                data= response.json()
-                if data['success']:
-                    return (data['obj'][0]['up'], data['obj'][0]['down'], data['obj'][0]['total'])
-                else:
-                    logger.warning(f"Не удалось получить трафик клиента {uuid}: {data['msg']}")
-                    return False
+        response, data = await self._request('GET', f"panel/api/inbounds/getClientTrafficsById/{uuid}", retry=RETRY)
+        if data is not None:
+            if data['success'] and data['obj']:
+                return (data['obj'][0]['up'], data['obj'][0]['down'], data['obj'][0]['total'])
             else:
-                logger.warning(f"Не удалось получить трафик клиента {uuid}: {response.status_code}")
+                logger.warning(f"Не удалось получить трафик клиента {uuid}: {data['msg']}")
                 return False
+        else:
+            logger.warning(f"Не удалось получить трафик клиента {uuid}: {response.status_code}")
+            return False
 
 
+    def _inbound_is_fresh(self, max_age: float) -> bool:
+        return self._inbound is not None and time.monotonic() - self._inbound_fetched_at < max_age
 
 
-    async def get_client_vless(self, uuid):
-        if not self.cookies:
-            await self.auth()
-
-        async with AsyncClient() as client:
-            response = await client.get(url=f"{self.url}panel/api/inbounds/get/{self.indoub_id}", cookies=self.cookies)
-            
-            if response.status_code == 200:
-                data = response.json()['obj']
-                settings = self.strin_to_dict(data['settings'])
-                stream_settings = self.strin_to_dict(data['streamSettings'])
-                sniffing = self.strin_to_dict(data['sniffing'])
-                ip = self.url.split('/')[2].replace('https://', '').replace('http://', '').split(':')[0]
-
-                client = {}
-                for i in settings['clients']:
-                    if i['id'] == uuid:
-                        client = i
-                        break
-
-                if not client:
-                    logger.warning("Клиент не найден")
-                    return
-
-                return (
-                        f"vless://{uuid}@{ip}:{data['port']}?"
-                        f"type={stream_settings['network']}&"
-                        f"security={stream_settings.get('security', 'none')}&"
-                        f"encryption={settings.get('encryption', 'none')}&"
-                        f"path={stream_settings.get('xhttpSettings', {}).get('path', '') or stream_settings.get('wsSettings', {}).get('path', '')}&"
-                        f"pbk={stream_settings.get('realitySettings', {}).get('settings', {}).get('publicKey', 'none')}&"
-                        f"fp={stream_settings.get('realitySettings', {}).get('settings', {}).get('fingerprint', 'none')}&"
-                        f"sni={stream_settings.get('realitySettings', {}).get('target', 'none').split(':')[0]}&"
-                        f"sid={stream_settings.get('realitySettings', {}).get('shortIds', [''])[0]}&"
-                        f"spx=%2F&flow={client.get('flow', '')}#{quote(client['email'].split('_')[0])}"
-                    )
-            else:
-                logger.warning(f"Не удалось подключиться к индаубу: {self.url} - {response.status_code}")
+    def invalidate_inbound(self):
+        """Сбрасывает снимок индауба после изменения клиентов"""
+        self._inbound_fetched_at = 0.0
+
+
+    async def get_inbound(self, max_age: float = INBOUND_CACHE_TTL, deadline: float | None = None) -> dict | None:
+        """
+        Снимок индауба панели с разобранными settings, streamSettings и sniffing.
+        В течение max_age секунд отдается из памяти, обновление single-flight.
+        deadline - дедлайн операции, частью которой является запрос снимка
+        """
+        if self._inbound_is_fresh(max_age):
+            return self._inbound
+
+        async with self._inbound_lock:
+            if self._inbound_is_fresh(max_age):
+                return self._inbound
+
+            inbound = await self._fetch_inbound(deadline)
+            if inbound is None:
                 return
 
+            self._inbound = inbound
+            self._clients = {client['id']: client for client in inbound['settings'].get('clients') or []}
+            self._traffic = self._traffic_map(inbound)
+            self._inbound_fetched_at = time.monotonic()
+            return inbound
+
+
+    def _traffic_map(self, inbound: dict) -> dict[str, tuple] | None:
+        """(up, down, total) всех клиентов индауба из clientStats, ключи - email и uuid. None, если clientStats нет"""
+        if inbound.get('clientStats') is None:
+            return None
+
+        traffic = {}
+        for stats in inbound['clientStats']:
+            value = (stats['up'], stats['down'], stats['total'])
+            traffic[stats['email']] = value
+            if stats.get('uuid'):
+                traffic[stats['uuid']] = value
+
+        for uuid, client in self._clients.items():
+            if uuid not in traffic and client.get('email') in traffic:
+                traffic[uuid] = traffic[client['email']]
+        return traffic
+
+
+    async def client_traffic(self, uuid_or_email: str) -> tuple | None:
+        """
+        Трафик клиента из общего снимка индауба: один запрос к панели на всех клиентов
+        раз в TRAFFIC_CACHE_TTL вместо getClientTrafficsById на каждого.
+        Если панель не отдала clientStats или клиента в них нет - спрашиваем трафик этого клиента отдельно
+        """
+        if await self.get_inbound(max_age=TRAFFIC_CACHE_TTL) is None:
+            return
+
+        if self._traffic is not None and uuid_or_email in self._traffic:
+            return self._traffic[uuid_or_email]
+        return await self.client_remain_trafic(uuid_or_email) or None
+
+
+    async def _fetch_inbound(self, deadline: float | None = None) -> dict | None:
+        # clientStats (трафик клиентов) панель заполняет только в списке индаубов, в inbounds/get/{id} их нет
+        response, data = await self._request('GET', "panel/api/inbounds/list", retry=RETRY, deadline=deadline)
+
+        if data is None or not data['success']:
+            logger.warning(f"Не удалось подключиться к индаубу: {self.url} - {response.status_code}")
+            return
+
+        inbound = next((item for item in data['obj'] or [] if item.get('id') == self.indoub_id), None)
+        if inbound is None:
+            logger.warning(f"Индауб {self.indoub_id} не найден на панели {self.url}")
+            return
+
+        inbound['settings'] = self.strin_to_dict(inbound['settings'])
+        inbound['streamSettings'] = self.strin_to_dict(inbound['streamSettings'])
+        inbound['sniffing'] = self.strin_to_dict(inbound['sniffing'])
+        return inbound
+
+
+    def inbound_profile(self, inbound: dict) -> dict:
+        """
+        Параметры подключения, общие для всех клиентов индауба.
+        flow задается у каждого клиента отдельно: в профиле он есть, только если у всех клиентов одинаковый,
+        иначе None - общий шаблон ссылки для такого индауба не строится
+        """
+        settings = inbound['settings']
+        stream_settings = inbound['streamSettings']
+        reality = stream_settings.get('realitySettings', {})
+        # Клиенты, которых создает бот, без flow
+        flows = {client.get('flow', '') for client in settings.get('clients') or []} or {''}
+
+        return {
+            'host': self.url.split('/')[2].replace('https://', '').replace('http://', '').split(':')[0],
+            'port': inbound['port'],
+            'network': stream_settings['network'],
+            'security': stream_settings.get('security', 'none'),
+            'encryption': settings.get('encryption', 'none'),
+            'path': stream_settings.get('xhttpSettings', {}).get('path', '') or stream_settings.get('wsSettings', {}).get('path', ''),
+            'pbk': reality.get('settings', {}).get('publicKey', 'none'),
+            'fp': reality.get('settings', {}).get('fingerprint', 'none'),
+            'sni': reality.get('target', 'none').split(':')[0],
+            'sid': (reality.get('shortIds') or [''])[0],
+            'flow': flows.pop() if len(flows) == 1 else None,
+        }
 
-    async def delete_client(self, uuid):
-        if not self.cookies:
-            await self.auth()
-
-        async with AsyncClient() as client:
-            response = await client.post(url=self.url+f"panel/api/inbounds/{self.indoub_id}/delClient/{uuid}", cookies=self.cookies)
-            if response.status_code == 200:
-                data = response.json()
-                if data['success']:
-                    logger.info(f"Удален клиент {uuid}")
-                    return True
-                else:
-                    logger.warning(f"Не удалось удалить клиента {uuid}: {data['msg']}")
-                    return False
-            else:
-                logger.warning(f"Не удалось добавить клиента {uuid}: {response.status_code}")
-                return False
 
-    async def reset_client_traffic(self, email: str):
-        """Сбросить трафик клиента по email"""
-        if not self.cookies:
-            await self.auth()
+    async def get_inbound_profile(self) -> dict | None:
+        inbound = await self.get_inbound()
+        if inbound is None:
+            return
+        return self.inbound_profile(inbound)
 
-        async with AsyncClient() as client:
-            response = await client.post(
-                url=f"{self.url}panel/api/inbounds/{self.indoub_id}/resetClientTraffic/{email}",
-                cookies=self.cookies
-            )
-            if response.status_code == 200:
-                data = response.json()
-                if data['success']:
-                    logger.info(f"Сброшен трафик клиента {email}")
-                    return True
-                else:
-                    logger.warning(f"Не удалось сбросить трафик {email}: {data['msg']}")
-                    return False
-            else:
-                logger.warning(f"Не удалось сбросить трафик {email}: {response.status_code}")
-                return False
 
+    async def get_client_vless(self, uuid):
+        inbound = await self.get_inbound()
+        if inbound is None:
+            return
 
+        client = self._clients.get(uuid)
+        if not client:
+            logger.warning("Клиент не найден")
+            return
 
+        profile = self.inbound_profile(inbound)
+        profile['flow'] = client.get('flow', '')
+        return build_vless_link(uuid, profile, client['email'])
 
 
+    async def delete_client(self, uuid):
+        response, data = await self._request('POST', f"panel/api/inbounds/{self.indoub_id}/delClient/{uuid}")
+        if data is not None:
+            if data['success']:
+                logger.info(f"Удален клиент {uuid}")
+                self.invalidate_inbound()
+                return True
+            else:
+                logger.warning(f"Не удалось удалить клиента {uuid}: {data['msg']}")
+                return False
+        else:
+            logger.warning(f"Не удалось добавить клиента {uuid}: {response.status_code}")
+            return False
 
+    async def reset_client_traffic(self, email: str):
+        """Сбросить трафик клиента по email"""
+        response, data = await self._request(
+            'POST',
+            f"panel/api/inbounds/{self.indoub_id}/resetClientTraffic/{email}",
+            retry=RETRY
+        )
+        if data is not None:
+            if data['success']:
+                logger.info(f"Сброшен трафик клиента {email}")
+                return True
+            else:
+                logger.warning(f"Не удалось сбросить трафик {email}: {data['msg']}")
+                return False
+        else:
+            logger.warning(f"Не удалось сбросить трафик {email}: {response.status_code}")
+            return False